@@ -14,11 +14,12 @@ from .feed import allfeeds, wlock_all, stop_feeds, rlock_feed_objs, runlock_feed
 from .encoding import encoder
 from .server import CantoServer
 from .config import config, parse_locks, parse_unlocks
-from .storage import CantoShelf
+from .storage import storage_types, check_storage, parse_shelf_format,\
+        DEFAULT_SHELF_FORMAT
 from .fetch import CantoFetch
 from .hooks import on_hook, call_hook
 from .tag import alltags
-from .transform import eval_transform
+from .transform import eval_transform, transform_key
 from .plugins import PluginHandler, Plugin, try_plugins, set_program
 from .rwlock import alllocks, write_lock, read_lock
 from .locks import *
@@ -41,6 +42,10 @@ logging.basicConfig(
 
 log = logging.getLogger("CANTO-DAEMON")
 
+# How often, in seconds, feeds are swept for expired items between fetches.
+
+SWEEP_INTERVAL = 60
+
 class DaemonBackendPlugin(Plugin):
     pass
 
@@ -64,6 +69,9 @@ class CantoBackend(PluginHandler, CantoServer):
         # Whether fetching is inhibited.
         self.no_fetch = False
 
+        # When feeds are next swept for expired items.
+        self.next_sweep = 0
+
         self.watches = { "new_tags" : [],
                          "del_tags" : [],
                          "config" : [],
@@ -71,14 +79,18 @@ class CantoBackend(PluginHandler, CantoServer):
 
         self.autoattr = {}
 
-        # Per socket transforms.
+        # Per socket transforms, and { socket : { tag : (key, items) } } for
+        # their results.
         self.socket_transforms = {}
+        self.socktrans_cache = {}
 
         self.shelf = None
+        self.storage_type = "shelf"
+        self.shelf_format = DEFAULT_SHELF_FORMAT
 
         # No bad arguments.
         version = "canto-daemon " + REPLACE_VERSION + " " + GIT_HASH
-        optl = self.common_args("nhc:",["nofetch","help","cache="], version)
+        optl = self.common_args("nhc:",["nofetch","help","cache=","storage=","shelf-format="], version)
         if optl == -1:
             sys.exit(-1)
 
@@ -230,6 +242,9 @@ class CantoBackend(PluginHandler, CantoServer):
         if socket in list(self.socket_transforms.keys()):
             del self.socket_transforms[socket]
 
+        if socket in self.socktrans_cache:
+            del self.socktrans_cache[socket]
+
     # We need to be alerted on certain events, ensure
     # we get notified about them.
 
@@ -343,14 +358,28 @@ class CantoBackend(PluginHandler, CantoServer):
 
     @read_lock(attr_lock)
     @read_lock(feed_lock)
-    def _apply_socktrans(self, socket, tag):
+    def _apply_socktrans(self, socket, name, version, tag):
         feeds = allfeeds.items_to_feeds(tag)
         rlock_feed_objs(feeds)
         socktran_lock.acquire_read()
         try:
+            transforms = list(self.socket_transforms[socket].values())
+
+            # Reuse the last result, unless the tag or anything the
+            # transforms depend on has changed since.
+
+            key = transform_key(transforms, tag)
+            if key != None:
+                key = (version, key)
+                cache = self.socktrans_cache.setdefault(socket, {})
+                if name in cache and cache[name][0] == key:
+                    return cache[name][1][:]
+
+            for filt in transforms:
+                tag = filt(tag)
 
-            for filt in self.socket_transforms[socket]:
-                tag = self.socket_transforms[socket][filt](tag)
+            if key != None:
+                cache[name] = (key, tag[:])
         finally:
             socktran_lock.release_read()
             runlock_feed_objs(feeds)
@@ -361,10 +390,11 @@ class CantoBackend(PluginHandler, CantoServer):
         response = {}
 
         for tag in args:
+            version = alltags.served_versions.get(tag, 0)
             items = alltags.get_tag(tag)
 
             if socket in self.socket_transforms:
-                items = self._apply_socktrans(socket, items)
+                items = self._apply_socktrans(socket, tag, version, items)
 
             attr_list = []
 
@@ -400,19 +430,64 @@ class CantoBackend(PluginHandler, CantoServer):
 
         self.write(socket, "ATTRIBUTES", ret)
 
+    # ARCHIVED [ URL, ... ] -> { URL : { id : { attribute : value } ... } ... }
+
+    # Archived items aren't in any tag, so this is the only way to get them.
+
+    @read_lock(feed_lock)
+    def cmd_archived(self, socket, args):
+        ret = {}
+        for feed in allfeeds.get_feeds():
+            if feed.URL in args:
+                ret[feed.URL] = feed.get_archived()
+
+        self.write(socket, "ARCHIVED", ret)
+
+    # COUNTS { "tags" : [ tag, ... ], "feeds" : [ URL, ... ] } ->
+    #   { "tags" : { tag : { "total" : n, "read" : n, "unread" : n } ... },
+    #     "feeds" : { URL : { "total" : n, "read" : n, "unread" : n } ... } }
+
+    # Without "tags" or "feeds", all of them are counted. Tag counts are of the
+    # tag's transformed content, feed counts are of everything in the feed.
+
+    @read_lock(feed_lock)
+    @read_lock(tag_lock)
+    def cmd_counts(self, socket, args):
+        r = { "tags" : {}, "feeds" : {} }
+
+        if "tags" in args:
+            tags = args["tags"]
+        else:
+            tags = alltags.get_tags()
+
+        for tag in tags:
+            r["tags"][tag] = alltags.get_counts(tag)
+
+        for feed in allfeeds.get_feeds():
+            if "feeds" not in args or feed.URL in args["feeds"]:
+                r["feeds"][feed.URL] = feed.counts()
+
+        self.write(socket, "COUNTS", r)
+
+    # STATS {} -> { "shelf" : { ... }, "feeds" : { URL : { ... } ... } }
+
+    # Sync and cache counters, for tuning.
+
+    @read_lock(feed_lock)
+    def cmd_stats(self, socket, args):
+        feeds = {}
+        for feed in allfeeds.get_feeds():
+            feeds[feed.URL] = feed.projection_stats()
+
+        self.write(socket, "STATS", { "shelf" : self.shelf.stats(),
+            "feeds" : feeds })
+
     # SETATTRIBUTES { id : { attribute : value } ... } -> None
 
     @read_lock(feed_lock)
     @write_lock(tag_lock)
     def cmd_setattributes(self, socket, args):
-
-        feeds = allfeeds.items_to_feeds(list(args.keys()))
-        for f in feeds:
-            f.set_attributes(feeds[f], args)
-
-        tags = alltags.items_to_tags(list(args.keys()))
-        for t in tags:
-            call_hook("daemon_tag_change", [ t ])
+        allfeeds.set_attributes(args)
 
     # CONFIGS [ "top_sec", ... ] -> { "top_sec" : full_value }
 
@@ -572,6 +647,11 @@ class CantoBackend(PluginHandler, CantoServer):
             # Clean up any threads done updating.
             self.fetch.reap()
 
+            # Write out changes, like attributes set by clients, once they've
+            # settled.
+
+            self.shelf.sync()
+
             # Check whether feeds need to be updated and fetch
             # them if necessary.
 
@@ -581,6 +661,15 @@ class CantoBackend(PluginHandler, CantoServer):
                 self.fetch_manual = False
                 self.fetch_force = False
 
+            # Expire old items from feeds that haven't been updated lately,
+            # leaving those being updated right now to their index.
+
+            if time.time() >= self.next_sweep:
+                for feed in allfeeds.get_feeds():
+                    if not self.fetch.still_working(feed.URL):
+                        feed.sweep()
+                self.next_sweep = time.time() + SWEEP_INTERVAL
+
             call_hook("daemon_end_loop", [])
 
             time.sleep(1)
@@ -631,6 +720,9 @@ class CantoBackend(PluginHandler, CantoServer):
         print("\t-v/\t\tVerbose logging (for debug)")
         print("\t-D/--dir <dir>\tSet configuration directory.")
         print("\t-n/--nofetch\tJust serve content, don't fetch new content.")
+        print("\t--storage <type>\tStore feed content with: %s" %\
+                ", ".join(sorted(storage_types.keys())))
+        print("\t--shelf-format <codec[:level]>\tCompress shelf files with none, gzip, zlib or lzma")
         print("\n\nPlugin control\n")
         print("\t--noplugins\t\t\t\tDisable plugins")
         print("\t--enableplugins 'plugin1 plugin2...'\tEnable single plugins (overrides --noplugins)")
@@ -648,6 +740,18 @@ class CantoBackend(PluginHandler, CantoServer):
             elif opt in ['-h', '--help']:
                 self.print_help()
                 sys.exit(0)
+            elif opt in ['--storage']:
+                if arg not in storage_types:
+                    log.error("Error: Unknown storage type %s" % arg)
+                    return -1
+                self.storage_type = arg
+            elif opt in ['--shelf-format']:
+                try:
+                    parse_shelf_format(arg)
+                except ValueError as e:
+                    log.error("Error: Bad shelf format %s: %s" % (arg, e))
+                    return -1
+                self.shelf_format = arg
         return 0
 
     def sig_int(self, a, b):
@@ -698,7 +802,8 @@ class CantoBackend(PluginHandler, CantoServer):
                 log.info("Lock writer (thread %s):" % (lock.writer_id,))
                 log.info(''.join(writer_stack))
 
-        self.shelf.sync()
+        self.shelf.sync(True)
+        log.info("Shelf syncs: %s" % self.shelf.stats())
         gc.collect()
 
         # If we've got pympler installed, output a summary of memory usage.
@@ -781,10 +886,23 @@ class CantoBackend(PluginHandler, CantoServer):
         os.dup2(f.fileno(), sys.stderr.fileno())
 
     # Bring up storage, the only errors possible at this point are 
-    # fatal and handled lower in CantoShelf.
+    # fatal and handled lower in CantoShelf, except for feeds that were
+    # stored with another type we can't convert from.
 
     def get_storage(self):
-        self.shelf = CantoShelf(self.feed_path)
+        log.info("storage = %s (%s)" % (self.storage_type, self.shelf_format))
+
+        try:
+            check_storage(self.feed_path, self.storage_type)
+        except Exception as e:
+            err = "Error: %s" % e
+            print(err)
+            log.error(err)
+            call_hook("daemon_exit", [])
+            sys.exit(-1)
+
+        self.shelf = storage_types[self.storage_type](self.feed_path,
+                shelf_format = self.shelf_format)
 
     # Bring up config, the only errors possible at this point will
     # be fatal and handled lower in CantoConfig.
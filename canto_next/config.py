@@ -70,6 +70,8 @@ class CantoConfig():
                 ("rate", self.validate_int, False),
                 ("keep_time", self.validate_int, False),
                 ("keep_unread", self.validate_bool, False),
+                ("archive_time", self.validate_int, False),
+                ("stored_attributes", self.validate_string_list, False),
                 ("global_transform", self.validate_set_transform, False),
         ]
 
@@ -77,6 +79,8 @@ class CantoConfig():
                 "rate" : 10,
                 "keep_time" : 86400,
                 "keep_unread" : False,
+                "archive_time" : 0,
+                "stored_attributes" : [],
                 "global_transform" : "None",
         }
 
@@ -86,6 +90,8 @@ class CantoConfig():
                 ("rate", self.validate_int, False),
                 ("keep_time", self.validate_int, False),
                 ("keep_unread", self.validate_bool, False),
+                ("archive_time", self.validate_int, False),
+                ("stored_attributes", self.validate_string_list, False),
                 ("username", self.validate_string, False),
                 ("password", self.validate_string, False),
         ]
@@ -350,6 +356,12 @@ class CantoConfig():
                     if k in feed:
                         kws[k] = feed[k]
 
+                for k in [ "archive_time", "stored_attributes" ]:
+                    if k in feed:
+                        kws[k] = feed[k]
+                    else:
+                        kws[k] = self.final["defaults"][k]
+
                 feed = CantoFeed(self.shelf, feed["name"],\
                         feed["url"], feed["rate"], feed["keep_time"], feed["keep_unread"], **kws)
 
@@ -12,14 +12,28 @@ from .tag import alltags
 from .rwlock import RWLock, read_lock, write_lock
 from .locks import feed_lock, tag_lock
 from .hooks import call_hook
+from .item import CantoItem
 
+from threading import Lock
 import traceback
+import bisect
+import hashlib
 import logging
 import json
 import time
 
 log = logging.getLogger("FEED")
 
+# How many different attribute sets each feed keeps projections for.
+
+PROJECTION_SETS = 4
+
+# Attributes holding an item's content can be big, and are usually only asked
+# for an item at a time, so sets including them aren't worth keeping a second
+# copy of.
+
+PROJECTION_UNCACHED = [ "description", "summary", "summary_detail", "content" ]
+
 def dict_id(i):
     if type(i) == dict:
         return i
@@ -31,6 +45,14 @@ class CantoFeeds():
         self.feeds = {}
         self.dead_feeds = {}
 
+        # Bumped whenever item attributes change, so results derived from them
+        # (like transformed tags) know when they're stale. Attributes that
+        # aren't listed have only changed when content_version has.
+
+        self.attribute_versions = {}
+        self.content_version = 0
+        self.version_lock = Lock()
+
     @write_lock(feed_lock)
     def add_feed(self, URL, feed):
         self.order.append(URL)
@@ -68,6 +90,46 @@ class CantoFeeds():
                 f[feed] = [i]
         return f
 
+    # Set attributes { id : { attribute : value } } across any number of
+    # feeds, and retag them all at once so each changed tag is only announced
+    # once.
+
+    def set_attributes(self, attributes):
+        feeds = self.items_to_feeds(list(attributes.keys()))
+
+        updates = []
+        for feed in feeds:
+            updates.append((feed, feed.update_attributes(feeds[feed], attributes)))
+
+        feed_lock.acquire_read()
+        tag_lock.acquire_write()
+
+        for feed, updated in updates:
+            feed._apply_tags(updated, feed._tag(updated), [], updated)
+        alltags.do_tag_changes()
+
+        tag_lock.release_write()
+        feed_lock.release_read()
+
+    # Note that attributes have changed, or all of them if None.
+
+    def attributes_changed(self, attributes=None):
+        self.version_lock.acquire()
+        if attributes == None:
+            self.content_version += 1
+        else:
+            for attr in attributes:
+                self.attribute_versions[attr] =\
+                        self.attribute_versions.get(attr, 0) + 1
+        self.version_lock.release()
+
+    def attribute_version(self, attributes):
+        self.version_lock.acquire()
+        r = (self.content_version, tuple([ self.attribute_versions.get(attr, 0)\
+                for attr in attributes ]))
+        self.version_lock.release()
+        return r
+
     def all_parsed(self):
         for URL in self.dead_feeds:
             feed = self.dead_feeds[URL]
@@ -177,29 +239,106 @@ class CantoFeed(PluginHandler):
         if "password" in kwargs:
             self.password = kwargs["password"]
 
+        # Items older than this are moved to the shelf's archive, 0 to never
+        # archive.
+
+        self.archive_time = 0
+        if "archive_time" in kwargs:
+            self.archive_time = kwargs["archive_time"]
+
+        # Attributes (besides the id, and canto's own) to keep from the
+        # content, or empty to keep everything.
+
+        self.stored_attributes = []
+        if "stored_attributes" in kwargs:
+            self.stored_attributes = kwargs["stored_attributes"]
+
+        # Digest of the last content indexed, and when the old items kept
+        # alongside it are next due to expire. Until then, the same content
+        # doesn't need to be indexed again.
+
+        self.digest = None
+        self.expire_due = 0
+
+        # The canto_update and id of every stored entry, ordered by
+        # canto_update, so the entries that could have expired between fetches
+        # are always a prefix. None until we've indexed something. The current
+        # content all shares content_update, and isn't expired until it's gone
+        # from the feed.
+
+        self.expiry_times = None
+        self.expiry_ids = None
+        self.content_update = None
+
+        # The canto_update of the latest fetch that was skipped as unchanged.
+        # The content it skipped was still in the feed then, so once that
+        # content changes, whatever dropped out of it only starts aging from
+        # here.
+
+        self.skipped_update = None
+
+        # { (attribute, ...) : { id : { attribute : value } } } for the
+        # attribute sets clients keep asking for, so get_attributes doesn't
+        # have to go back to the entries. Anything that changes the entries
+        # bumps the generation, so lookups that raced with it aren't stored.
+
+        self.projections = {}
+        self.projection_hits = {}
+        self.projection_generation = 0
+        self.projection_lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        # { id : [ tag, ... ] } for the items we've tagged, as of the
+        # alltags.generation we tagged them in.
+
+        self.item_tags = {}
+        self.tags_generation = alltags.generation
+
+        # How many of those are read.
+
+        self.read_count = 0
+
         allfeeds.add_feed(URL, self)
 
     def __str__(self):
         return "CantoFeed: %s" % self.name
 
-    # Return { id : { attribute : value .. } .. }
+    # Return { id : { attribute : value .. } .. }, the dicts are the caller's
+    # to change.
 
     def get_attributes(self, items, attributes):
         r = {}
 
-        d = self.shelf[self.URL]
+        generation = self.projection_generation
+        missing = []
 
-        args = [ (dict_id(item)["ID"], item, attributes[item]) for item in items ]
-        args.sort()
+        for item in items:
+            id = dict_id(item)["ID"]
+            key = tuple(attributes[item])
+
+            projection = self.projections.get(key)
+            if projection != None:
+                attrs = projection.get(id)
+                if attrs != None:
+                    self.projection_hits[key] = self.projection_hits.get(key, 0) + 1
+                    r[item] = attrs.copy()
+                    continue
+
+            missing.append((id, item, key))
+
+        self.hits += len(items) - len(missing)
+        self.misses += len(missing)
 
-        got = [ (item["id"], item) for item in d["entries"] ]
-        got.sort()
+        if not missing:
+            return r
 
-        for item, full_id, needed_attrs in args:
-            while got and item > got[0][0]:
-                got.pop(0)
+        got = self.shelf.get_items(self.URL, [ a[0] for a in missing ])
+        fresh = {}
 
-            if got and got[0][0] == item:
+        for item, full_id, needed_attrs in missing:
+            if item in got:
                 attrs = {}
                 for a in needed_attrs:
                     if a == "description":
@@ -207,48 +346,112 @@ class CantoFeed(PluginHandler):
                     else:
                         real = a
 
-                    if real in got[0][1]:
-                        attrs[a] = got[0][1][real]
-                    else:
-                        attrs[a] = ""
+                    attrs[a] = got[item].get(real, "")
                 r[full_id] = attrs
-                got.pop(0)
+
+                if any([ a in PROJECTION_UNCACHED for a in needed_attrs ]):
+                    continue
+
+                if needed_attrs not in fresh:
+                    fresh[needed_attrs] = {}
+                fresh[needed_attrs][item] = attrs.copy()
             else:
                 log.warn("item not found: %s" % item)
                 r[full_id] = {}
                 for a in needed_attrs:
                     r[full_id][a] = ""
                 r[full_id]["title"] = "???"
+
+        self._store_projections(generation, fresh)
         return r
 
+    def _store_projections(self, generation, fresh):
+        with self.projection_lock:
+            if generation != self.projection_generation:
+                return
+
+            for key, attrs in fresh.items():
+                if key not in self.projections:
+
+                    # Make room by dropping the least used set.
+
+                    if len(self.projections) >= PROJECTION_SETS:
+                        coldest = min(self.projections,
+                                key=lambda k: self.projection_hits.get(k, 0))
+                        del self.projections[coldest]
+                        self.projection_hits.pop(coldest, None)
+
+                    self.projections[key] = {}
+                self.projections[key].update(attrs)
+
+    # Forget the projections of ids, or all of them.
+
+    def _invalidate_projections(self, ids=None):
+        with self.projection_lock:
+            if ids == None:
+                self.projections = {}
+            else:
+                for projection in self.projections.values():
+                    for id in ids:
+                        projection.pop(id, None)
+            self.projection_generation += 1
+
+    def counts(self):
+        total = len(self.item_tags)
+        return { "total" : total,
+                 "read" : self.read_count,
+                 "unread" : total - self.read_count }
+
+    def projection_stats(self):
+        return { "hits" : self.hits,
+                 "misses" : self.misses,
+                 "sets" : [ list(key) for key in self.projections ],
+                 "items" : sum([ len(p) for p in self.projections.values() ]) }
+
     # Given an ID and a dict of attributes, update the disk.
     def set_attributes(self, items, attributes):
+        updated = self.update_attributes(items, attributes)
+        self._retag(updated, self._tag(updated), [], updated)
 
-        self.lock.acquire_write()
+    # Update the disk, and return the updated entries, which still need to be
+    # retagged.
 
-        d = self.shelf[self.URL]
+    def update_attributes(self, items, attributes):
 
-        items_to_remove = []
-        tags_to_add = []
+        self.lock.acquire_write()
 
+        changes = {}
         for item in items:
-            d_id = dict_id(item)["ID"]
+            changes[dict_id(item)["ID"]] = attributes[item]
 
-            for d_item in d["entries"]:
-                if d_id != d_item["id"]:
-                    continue
-                for a in attributes[item]:
-                    d_item[a] = attributes[item][a]
+        updated = self.shelf.update_items(self.URL, changes)
+
+        self._invalidate_projections(list(changes.keys()))
+
+        changed = set()
+        for attrs in changes.values():
+            changed.update(attrs.keys())
+        allfeeds.attributes_changed(changed)
 
-                items_to_remove.append(d_item)
-                tags_to_add += self._tag([d_item])
+        # Reading an item can make it eligible for discarding.
+
+        self.digest = None
+        if "canto-state" in changed:
+            self.expire_due = 0
 
-        self.shelf[self.URL] = d
         self.shelf.update_umod()
 
         self.lock.release_write()
 
-        self._retag(items_to_remove, tags_to_add, [])
+        return updated
+
+    # Return { id : item } for items that have been moved to the archive.
+
+    def get_archived(self):
+        r = {}
+        for item in self.shelf.get_archived(self.URL):
+            r[self._item_id(item)] = item
+        return r
 
     def _item_id(self, item):
         return json.dumps({ "URL" : self.URL, "ID" : item["id"] })
@@ -265,27 +468,120 @@ class CantoFeed(PluginHandler):
 
         return tags_to_add
 
-    def _retag(self, items_to_remove, tags_to_add, tags_to_remove):
+    # Items_to_remove lose all of their tags, before tags_to_add are applied
+    # and then tags_to_remove. Only the tags whose membership actually changes
+    # are updated, with the items involved laid out in the order they were
+    # given. Tags holding touched items are changed anyway, since their
+    # attributes might affect the transforms.
+
+    def _retag(self, items_to_remove, tags_to_add, tags_to_remove, touched=[]):
         feed_lock.acquire_read()
         tag_lock.acquire_write()
 
-        for item in items_to_remove:
-            alltags.remove_id(self._item_id(item))
+        self._apply_tags(items_to_remove, tags_to_add, tags_to_remove, touched)
+        alltags.do_tag_changes()
+
+        tag_lock.release_write()
+        feed_lock.release_read()
+
+    # The guts of _retag, must be called with tag_lock held with write.
+
+    def _apply_tags(self, items_to_remove, tags_to_add, tags_to_remove, touched):
+
+        # Tags have been cleared since we last tagged anything.
+
+        if self.tags_generation != alltags.generation:
+            self.item_tags = {}
+            self.read_count = 0
+            self.tags_generation = alltags.generation
+
+        removed = set([ self._item_id(item) for item in items_to_remove ])
 
+        # { id : read } for items we've been given the content of.
+
+        states = {}
+        for item in touched:
+            states[self._item_id(item)] = self._is_read(item)
+
+        # { id : [ tag, ... ] } for every item involved, in order.
+
+        new_tags = {}
         for item, tag in tags_to_add:
-            alltags.add_tag(self._item_id(item), tag)
+            id = self._item_id(item)
+            if id not in new_tags:
+                if id in removed:
+                    new_tags[id] = []
+                else:
+                    new_tags[id] = self.item_tags.get(id, [])[:]
+                states[id] = self._is_read(item)
+            for name in alltags.expand_tag(tag):
+                if name not in new_tags[id]:
+                    new_tags[id].append(name)
+
+        for id in removed:
+            if id not in new_tags:
+                new_tags[id] = []
 
         for item, tag in tags_to_remove:
-            alltags.remove_tag(self._item_id(item), tag)
+            id = self._item_id(item)
+            if id not in new_tags:
+                new_tags[id] = self.item_tags.get(id, [])[:]
+            if tag in new_tags[id]:
+                new_tags[id].remove(tag)
+
+        # { tag : [ id, ... ] } for the tags that actually changed.
+
+        changed = {}
+        for id, tags in new_tags.items():
+            old_tags = self.item_tags.get(id, [])
+            if old_tags == tags:
+                continue
 
-        alltags.do_tag_changes()
+            for tag in old_tags + tags:
+                if (tag in old_tags) != (tag in tags):
+                    changed[tag] = []
 
-        tag_lock.release_write()
-        feed_lock.release_read()
+        for id, tags in new_tags.items():
+            for tag in tags:
+                if tag in changed:
+                    changed[tag].append(id)
 
-    def _keep_olditem(self, olditem):
-        ref_time = time.time()
+            was_read = id in alltags.read_ids
+            if not tags:
+                read = False
+            else:
+                read = states.get(id, was_read)
+
+            # The counts for tags that didn't otherwise change still need
+            # updating.
+
+            if read != was_read:
+                alltags.set_read(id, read)
+                self.read_count += read - was_read
+                for tag in tags:
+                    alltags.item_changed(id, tag)
 
+            if tags:
+                self.item_tags[id] = tags
+            elif id in self.item_tags:
+                del self.item_tags[id]
+
+        for tag in changed:
+            alltags.update_tag(tag, new_tags, changed[tag])
+
+        for item in touched:
+            id = self._item_id(item)
+            if id in self.item_tags:
+                for tag in self.item_tags[id]:
+                    alltags.item_changed(id, tag)
+
+    def _is_read(self, item):
+        return "canto-state" in item and "read" in item["canto-state"]
+
+    # Items that aren't kept are discarded, unless they're past archive_time,
+    # in which case they're added to archived.
+
+    def _keep_olditem(self, olditem, archived, ref_time):
         if "canto_update" not in olditem:
             olditem["canto_update"] = ref_time
 
@@ -296,16 +592,119 @@ class CantoFeed(PluginHandler):
         else:
             item_state = []
 
+        if self.archive_time and (ref_time - item_time) >= self.archive_time:
+            log.debug("Archiving: %s", olditem["id"])
+            archived.append(olditem)
+            return False
+
         if (ref_time - item_time) < self.keep_time:
-            log.debug("Item not over keep_time (%d): %s", 
-                    self.keep_time, olditem["id"])
+            return True
         elif self.keep_unread and "read" not in item_state:
-            log.debug("Keeping unread item: %s\n", olditem["id"])
+            log.debug("Keeping unread item: %s", olditem["id"])
         else:
             log.debug("Discarding: %s", olditem["id"])
             return False
         return True
 
+    # Sort the entries we're storing by canto_update, see expiry_times.
+
+    def _index_expiry(self, entries):
+        order = sorted([ (item.get("canto_update", 0), item["id"])\
+                for item in entries ], key=lambda x : x[0])
+
+        self.expiry_times = [ t for t, id in order ]
+        self.expiry_ids = [ id for t, id in order ]
+
+    # Entries last updated after this, at ref_time, can't have expired.
+
+    def _expiry_cutoff(self, ref_time):
+        horizon = self.keep_time
+        if self.archive_time:
+            horizon = min(horizon, self.archive_time)
+        return ref_time - horizon
+
+    # Return the ids of the entries that might be due to expire at ref_time,
+    # leaving out any updated at or after before.
+
+    def _expiry_candidates(self, ref_time, before=None):
+        if self.expiry_times == None:
+            return set()
+
+        end = bisect.bisect_right(self.expiry_times, self._expiry_cutoff(ref_time))
+        if before != None:
+            end = min(end, bisect.bisect_left(self.expiry_times, before))
+
+        return set(self.expiry_ids[:end])
+
+    # Return the earliest time any of entries, which aren't in the current
+    # content, can expire. Unread items kept past keep_time only expire once
+    # they're read, which resets the digest and expire_due.
+
+    def _expire_due(self, entries, ref_time):
+        due = float("inf")
+
+        for item in entries:
+            item_time = item.get("canto_update", ref_time)
+
+            if self.archive_time:
+                due = min(due, item_time + self.archive_time)
+            if item_time + self.keep_time > ref_time or not self.keep_unread\
+                    or self._is_read(item):
+                due = min(due, item_time + self.keep_time)
+        return due
+
+    # The entries that aren't part of the current content.
+
+    def _old_entries(self, entries):
+        if self.content_update == None:
+            return entries
+        return [ item for item in entries\
+                if item.get("canto_update", 0) < self.content_update ]
+
+    # Drop any attributes we don't store, and pack the rest into a CantoItem.
+    # Clients get "description" from "summary", so storing one stores both.
+
+    def _compact(self, item):
+        if self.stored_attributes:
+            stored = set(self.stored_attributes)
+            if "description" in stored:
+                stored.add("summary")
+
+            item = dict([ (key, value) for key, value in item.items()\
+                    if key == "id" or key.startswith("canto") or key in stored ])
+        return CantoItem(item)
+
+    def _item_changed(self, item, olditem):
+        if isinstance(item, CantoItem) and isinstance(olditem, CantoItem):
+            olditem = olditem.copy()
+            if "canto_update" in item:
+                olditem["canto_update"] = item["canto_update"]
+            return item != olditem
+
+        item = dict(item.items())
+        olditem = dict(olditem.items())
+        item.pop("canto_update", None)
+        olditem.pop("canto_update", None)
+        return item != olditem
+
+    def _editing_plugins(self):
+        for attr in self.plugin_attrs:
+            if attr.startswith("additems_") or attr.startswith("edit_"):
+                return True
+        return False
+
+    # Digest entries one at a time, so big feeds aren't serialized in one go.
+
+    def _digest(self, entries):
+        h = hashlib.sha1()
+        try:
+            for entry in entries:
+                h.update(json.dumps(entry, sort_keys=True).encode("UTF-8"))
+        except Exception as e:
+            log.debug("Unable to digest %s: %s", self.URL, e)
+            return None
+        return h.digest()
+
     # Re-index contents
     # If we have update_contents, use that
     # If not, at least populate self.items from disk.
@@ -319,19 +718,31 @@ class CantoFeed(PluginHandler):
         if self.stopped:
             return
 
+        digest = None
+        if update_contents["entries"]:
+            digest = self._digest(update_contents["entries"])
+
         self.lock.acquire_write()
 
-        if self.URL not in self.shelf:
-            # Stub empty feed
-            log.debug("Previous content not found for %s.", self.URL)
-            old_contents = {"entries" : []}
-        else:
-            old_contents = self.shelf[self.URL]
-            log.debug("Fetched previous content for %s.", self.URL)
+        ref_time = time.time()
+
+        # Nothing has changed since the last index, skip merging and retagging
+        # altogether. Plugins that add or edit items (like syncing state from
+        # elsewhere) need to run on every update, so not with any of those.
+
+        if digest and digest == self.digest and ref_time < self.expire_due\
+                and self.URL in self.shelf and not self._editing_plugins():
+            log.debug("%s unchanged, skipping index.", self.URL)
+            self.skipped_update = update_contents["canto_update"]
+            self.lock.release_write()
+            return
+
+        # The ids of the new entries, the first copy of an id wins.
 
+        new_ids = set()
         new_entries = []
 
-        for i, item in enumerate(update_contents["entries"]):
+        for item in update_contents["entries"]:
 
             # Update canto_update only for freshly seen items.
             item["canto_update"] = update_contents["canto_update"]
@@ -346,72 +757,118 @@ class CantoFeed(PluginHandler):
                     log.error("Unable to uniquely ID item: %s" % item)
                     continue
 
-            new_entries.append((i, item["id"], item))
-
-        # Sort by string id
-        new_entries.sort(key=lambda x: x[1])
+            if item["id"] in new_ids:
+                continue
 
-        # Remove duplicates
-        last_id = ""
-        for x in new_entries[:]:
-            if x[1] == last_id:
-                new_entries.remove(x)
-            else:
-                last_id = x[1]
+            new_ids.add(item["id"])
+            new_entries.append(item)
 
-        old_entries = [ (i, item["id"], item) for (i, item) in enumerate(old_contents["entries"])]
+        # Entries are compacted in place before they're committed, so don't
+        # hold onto the originals.
 
-        old_entries.sort(key=lambda x: x[1])
+        update_contents["entries"] = new_entries
 
         keep_all = new_entries == []
 
-        kept_entries = []
+        # The ids of the content we last indexed, if fetches of it were
+        # skipped since. Without new content, they're still current.
 
-        for x in new_entries:
+        seen_ids = set()
+        if not keep_all and self.skipped_update != None and\
+                self.content_update != None:
+            start = bisect.bisect_left(self.expiry_times, self.content_update)
+            end = bisect.bisect_right(self.expiry_times, self.content_update)
+            seen_ids = set(self.expiry_ids[start:end])
 
-            # old_entry is really old, see if we should keep or discard
+        # If the shelf can discard old items itself, let it do so before we
+        # load the previous content, but never discard items we're about to
+        # merge with. Items it removes past archive_time still need archiving.
 
-            while old_entries and x[1] > old_entries[0][1]:
-                if keep_all or self._keep_olditem(old_entries[0][2]):
-                    kept_entries.append(old_entries.pop(0))
-                else:
-                    old_entries.pop(0)
+        expired = []
+        archived = []
+        if not keep_all and hasattr(self.shelf, "expire_items"):
+            archive_cutoff = None
+            if self.archive_time:
+                archive_cutoff = ref_time - self.archive_time
+
+            expired = self.shelf.expire_items(self.URL,
+                    ref_time - self.keep_time, self.keep_unread,
+                    new_ids | seen_ids, archive_cutoff, archived)
+            expired += archived
+
+        # Without new content, like the from-disk index at startup, we only
+        # keep what's already stored, so unless plugins change something
+        # there's nothing to write back.
+
+        unchanged = False
+
+        if self.URL not in self.shelf:
+            # Stub empty feed
+            log.debug("Previous content not found for %s.", self.URL)
+            old_contents = {"entries" : []}
+
+        # All we need to retag what we're keeping is a summary, if the shelf
+        # can give us one without loading the feed.
+
+        elif keep_all and not self._editing_plugins() and\
+                hasattr(self.shelf, "get_summary"):
+            old_contents = self.shelf.get_summary(self.URL)
+            log.debug("Fetched summary for %s.", self.URL)
+            unchanged = True
+        else:
+            old_contents = self.shelf[self.URL]
+            log.debug("Fetched previous content for %s.", self.URL)
+            unchanged = keep_all
+
+        old_ids = {}
+        for olditem in old_contents["entries"]:
+            if olditem["id"] not in old_ids:
+                old_ids[olditem["id"]] = olditem
+
+        for item in new_entries:
 
             # new entry and old entry match, move content over
 
-            if old_entries and x[1] == old_entries[0][1]:
-                olditem = old_entries.pop(0)[2]
+            if item["id"] in old_ids:
+                olditem = old_ids[item["id"]]
                 for key in olditem:
                     if key == "canto_update":
                         continue
                     elif key.startswith("canto"):
-                        x[2][key] = olditem[key]
+                        item[key] = olditem[key]
 
             # new entry is really new, tell everyone
 
             else:
-                call_hook("daemon_new_item", [self, x[2]])
+                call_hook("daemon_new_item", [self, item])
 
-        # Resort lists by place, instead of string id
-        new_entries.sort()
-        old_entries.sort()
+        # Old entries that weren't merged are kept, in their old order, after
+        # the new ones, if they haven't expired. Only those old enough to have
+        # expired need checking.
 
-        if keep_all:
-            kept_entries += old_entries
-        else:
-            for x in old_entries:
-                if self._keep_olditem(x[2]):
-                    kept_entries.append(x)
+        kept_entries = []
 
-        kept_entries.sort()
-        new_entries += kept_entries
+        cutoff = self._expiry_cutoff(ref_time)
 
-        update_contents["entries"] = [ x[2] for x in new_entries ]
+        for olditem in old_contents["entries"]:
+            if olditem["id"] in new_ids and old_ids[olditem["id"]] is olditem:
+                continue
+            if olditem["id"] in seen_ids:
+                olditem["canto_update"] = self.skipped_update
+            if keep_all or olditem.get("canto_update", 0) > cutoff or\
+                    self._keep_olditem(olditem, archived, ref_time):
+                kept_entries.append(olditem)
+
+        update_contents["entries"] = new_entries + kept_entries
 
         tags_to_add = self._tag(update_contents["entries"])
         tags_to_remove = []
         remove_items = []
 
+        # Whether plugins have had a chance to change the content.
+
+        edited = False
+
         # Allow plugins to add items prior to running the editing functions
         # so that the editing functions are guaranteed the full list.
 
@@ -421,6 +878,7 @@ class CantoFeed(PluginHandler):
 
             try:
                 a = getattr(self, attr)
+                edited = True
                 tags_to_add, tags_to_remove, remove_items = a(self, update_contents, tags_to_add, tags_to_remove, remove_items)
             except:
                 log.error("Error running feed item adding plugin")
@@ -435,22 +893,121 @@ class CantoFeed(PluginHandler):
 
             try:
                 a = getattr(self, attr)
+                edited = True
                 tags_to_add, tags_to_remove, remove_items = a(self, update_contents, tags_to_add, tags_to_remove, remove_items)
             except:
                 log.error("Error running feed editing plugin")
                 log.error(traceback.format_exc())
 
         if not self.stopped:
+            # Only compact entries once plugins are done with them, so they
+            # see everything the feed had to offer, and read and write plain
+            # dicts.
+
+            touched = []
+
+            entries = update_contents["entries"]
+            for i, item in enumerate(entries):
+                if type(item) != dict:
+                    continue
+
+                olditem = old_ids.get(item["id"])
+                entries[i] = self._compact(item)
+
+                if olditem != None and olditem is not item and\
+                        self._item_changed(entries[i], olditem):
+                    touched.append(entries[i])
+
             # Commit the updates to disk.
 
-            self.shelf[self.URL] = update_contents
+            if archived:
+                self.shelf.archive_items(self.URL, archived)
+
+            if not unchanged or edited:
+                self.shelf[self.URL] = update_contents
+                self._invalidate_projections()
+
+            # New and discarded items only change tag membership.
+
+            if touched or edited:
+                allfeeds.attributes_changed()
+
+            self.digest = digest
+
+            self._index_expiry(update_contents["entries"])
+            if not keep_all:
+                self.content_update = update_contents["canto_update"]
+                self.skipped_update = None
+            elif self.content_update == None and self.expiry_times:
+                self.content_update = self.expiry_times[-1]
+
+            if keep_all:
+                kept_entries = self._old_entries(update_contents["entries"])
+            self.expire_due = self._expire_due(kept_entries, ref_time)
 
             self.lock.release_write()
 
-            self._retag(old_contents["entries"] + remove_items, tags_to_add, tags_to_remove)
+            self._retag(old_contents["entries"] + expired + remove_items, tags_to_add, tags_to_remove, touched)
         else:
             self.lock.release_write()
 
+    # Expire old entries between fetches, so feeds with a long rate, or that
+    # have stopped updating, don't hold onto them.
+
+    def sweep(self):
+        if self.stopped:
+            return
+
+        self.lock.acquire_write()
+
+        ref_time = time.time()
+
+        # Nothing can have expired yet, like when all the old items are unread
+        # ones we're keeping.
+
+        if ref_time < self.expire_due:
+            self.lock.release_write()
+            return
+
+        candidates = self._expiry_candidates(ref_time, self.content_update)
+        if not candidates or self.URL not in self.shelf:
+            self.lock.release_write()
+            return
+
+        contents = self.shelf[self.URL]
+
+        kept_entries = []
+        expired = []
+        archived = []
+
+        for olditem in contents["entries"]:
+            if olditem["id"] not in candidates or\
+                    self._keep_olditem(olditem, archived, ref_time):
+                kept_entries.append(olditem)
+            else:
+                expired.append(olditem)
+
+        self.expire_due = self._expire_due(self._old_entries(kept_entries), ref_time)
+
+        if not expired:
+            self.lock.release_write()
+            return
+
+        log.debug("Swept %d items from %s", len(expired), self.URL)
+
+        if archived:
+            self.shelf.archive_items(self.URL, archived)
+
+        contents = contents.copy()
+        contents["entries"] = kept_entries
+        self.shelf[self.URL] = contents
+        self._invalidate_projections()
+        self._index_expiry(kept_entries)
+
+        self.lock.release_write()
+
+        self._retag(expired, [], [])
+
     def destroy(self):
         # Check for existence in case of delete quickly
         # after add.
@@ -28,6 +28,22 @@ log = logging.getLogger("CANTO-FETCH")
 class DaemonFetchThreadPlugin(Plugin):
     pass
 
+# feedparser results are full of FeedParserDicts and struct_times, which can't
+# be stored. Convert them to plain JSON types an entry at a time, dropping each
+# original as we go, rather than holding the whole result, its JSON, and the
+# copy all at once.
+
+def normalize_contents(result):
+    entries = result.pop("entries", [])
+
+    contents = json.loads(json.dumps(result))
+
+    for i, entry in enumerate(entries):
+        entries[i] = json.loads(json.dumps(entry))
+
+    contents["entries"] = entries
+    return contents
+
 # This is the first time I've ever had a need for multiple inheritance.
 # I'm not sure if that's a good thing or not =)
 
@@ -121,7 +137,7 @@ class CantoFetchThread(PluginHandler, Thread):
         # Update timestamp
         update_contents["canto_update"] = self.feed.last_update
 
-        update_contents = json.loads(json.dumps(update_contents))
+        update_contents = normalize_contents(update_contents)
 
         log.debug("Parsed %s", self.feed.URL)
 
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+#Canto - RSS reader backend
+#   Copyright (C) 2014 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+from collections.abc import MutableMapping, Mapping
+
+import json
+import zlib
+
+# Attributes that clients ask for all the time get a slot of their own. The
+# rest of the item (content, *_detail dicts, links, etc.) is kept as
+# compressed JSON, and only decoded when one of them is actually read.
+
+item_slots = {
+    "id" : "id",
+    "title" : "title",
+    "link" : "link",
+    "canto_update" : "updated",
+    "canto-state" : "state",
+    "canto-tags" : "tags",
+}
+
+def encode_blob(d):
+    if not d:
+        return None
+    return zlib.compress(json.dumps(d, sort_keys=True,
+        separators=(",",":")).encode("UTF-8"))
+
+def decode_blob(blob):
+    if blob == None:
+        return {}
+    return json.loads(zlib.decompress(blob).decode("UTF-8"))
+
+# For json.dump(s), so items that aren't dicts can be written out like them.
+
+def encode_item(obj):
+    if isinstance(obj, Mapping):
+        return dict(obj.items())
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+class CantoItem(MutableMapping):
+    __slots__ = [ "id", "title", "link", "updated", "state", "tags", "blob" ]
+
+    def __init__(self, item={}):
+        rest = {}
+        for key, value in item.items():
+            if key in item_slots:
+                setattr(self, item_slots[key], value)
+            else:
+                rest[key] = value
+        self.blob = encode_blob(rest)
+
+    def _slot_items(self):
+        for key, slot in item_slots.items():
+            if hasattr(self, slot):
+                yield (key, getattr(self, slot))
+
+    def to_dict(self):
+        r = dict(self._slot_items())
+        r.update(decode_blob(self.blob))
+        return r
+
+    def __getitem__(self, key):
+        if key in item_slots:
+            try:
+                return getattr(self, item_slots[key])
+            except AttributeError:
+                raise KeyError(key)
+        return decode_blob(self.blob)[key]
+
+    def __contains__(self, key):
+        if key in item_slots:
+            return hasattr(self, item_slots[key])
+        return key in decode_blob(self.blob)
+
+    def __iter__(self):
+        for key, value in self._slot_items():
+            yield key
+        for key in decode_blob(self.blob):
+            yield key
+
+    def __len__(self):
+        return len(list(self._slot_items())) + len(decode_blob(self.blob))
+
+    def __setitem__(self, key, value):
+        if key in item_slots:
+            setattr(self, item_slots[key], value)
+        else:
+            rest = decode_blob(self.blob)
+            rest[key] = value
+            self.blob = encode_blob(rest)
+
+    def __delitem__(self, key):
+        if key in item_slots:
+            try:
+                delattr(self, item_slots[key])
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            rest = decode_blob(self.blob)
+            del rest[key]
+            self.blob = encode_blob(rest)
+
+    # Avoid decoding the blob once per attribute.
+
+    def items(self):
+        return self.to_dict().items()
+
+    def values(self):
+        return self.to_dict().values()
+
+    def copy(self):
+        r = CantoItem.__new__(CantoItem)
+        for key, slot in item_slots.items():
+            if hasattr(self, slot):
+                setattr(r, slot, getattr(self, slot))
+        r.blob = self.blob
+        return r
+
+    # The blob is deterministic, so two CantoItems can be compared without
+    # decoding either of them.
+
+    def __eq__(self, other):
+        if not isinstance(other, CantoItem):
+            return Mapping.__eq__(self, other)
+        if self.blob != other.blob:
+            return False
+        return list(self._slot_items()) == list(other._slot_items())
+
+    def __repr__(self):
+        return repr(self.to_dict())
@@ -124,6 +124,7 @@ class CantoRemote(PluginHandler, CantoClient):
         print("\tlistfeeds - list all subscribed feeds")
         print("\tdelfeed - unsubscribe from a feed")
         print("\tstatus - print item counts")
+        print("\tstats - print daemon cache statistics")
         print("\tforce-update - refetch all feeds")
         print("\tconfig - change / query configuration variables")
         print("\tone-config - change / query one configuration variable")
@@ -480,29 +481,10 @@ class CantoRemote(PluginHandler, CantoClient):
 
         self.write("FORCEUPDATE", {})
 
-    def _numstate(self, tag, state):
-        self.write("AUTOATTR", [ "canto-state" ])
-        self.write("ITEMS", [ tag ])
-
-        items = []
-
-        cmd, r = self._wait_response(None)
-        while cmd != "ITEMSDONE":
-            if cmd == "ITEMS":
-                items.extend(r[tag])
-            cmd, r = self._wait_response(None)
-
-        if len(items) == 0:
-            return 0
-
-        attrs = self._wait_response("ATTRIBUTES")
-
-        if state == "unread":
-            return len([ x for x in items if "read" not in attrs[x]["canto-state"]])
-        elif state == "read":
-            return len([ x for x in items if "read" in attrs[x]["canto-state"]])
-        else:
-            return len(items)
+    def _numstate(self, counts, state):
+        if state == "all":
+            return counts["total"]
+        return counts[state]
 
     def cmd_status(self):
         """USAGE: canto-remote status (--tag=tag) (--read|--total|--tags)
@@ -531,9 +513,12 @@ class CantoRemote(PluginHandler, CantoClient):
         self.write("LISTTAGS","")
         t = self._wait_response("LISTTAGS")
 
+        self.write("COUNTS", { "tags" : t, "feeds" : [] })
+        counts = self._wait_response("COUNTS")["tags"]
+
         if "--tags" in sys.argv:
             for tag in t:
-                print("%s : %s" % (tag, self._numstate(tag, state)))
+                print("%s : %s" % (tag, self._numstate(counts[tag], state)))
         elif "--tag" in sys.argv:
             if "--tag" == sys.argv[-1]:
                 print("--tag must be followed by a tag name")
@@ -544,9 +529,37 @@ class CantoRemote(PluginHandler, CantoClient):
                 print("Unknown tag %s - use --tags to list known tags" % tag)
                 sys.exit(-1)
 
-            print("%s : %s" % (tag, self._numstate(tag, state)))
+            print("%s : %s" % (tag, self._numstate(counts[tag], state)))
         else:
-            print("%s" % sum([self._numstate(tag, state) for tag in t ]))
+            print("%s" % sum([self._numstate(counts[tag], state) for tag in t ]))
+
+    def cmd_stats(self):
+        """USAGE: canto-remote stats
+
+    Print how often each feed's attribute requests were answered from cache,
+    and how many shelf syncs the daemon has done."""
+
+        self.write("STATS", {})
+        r = self._wait_response("STATS")
+        if not r:
+            return
+
+        hits = 0
+        total = 0
+
+        for URL in sorted(r["feeds"].keys()):
+            s = r["feeds"][URL]
+            n = s["hits"] + s["misses"]
+            if n:
+                print("%s : %d/%d (%d%%) cached, %d items" %\
+                        (URL, s["hits"], n, (100 * s["hits"]) // n, s["items"]))
+            hits += s["hits"]
+            total += n
+
+        if total:
+            print("Total : %d/%d (%d%%) cached" % (hits, total, (100 * hits) // total))
+
+        print("Shelf syncs : %s" % r["shelf"])
 
     def cmd_help(self):
         """USAGE: canto-remote help [command]"""
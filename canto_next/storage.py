@@ -9,22 +9,788 @@
 
 from .feed import wlock_feeds
 from .hooks import call_hook
+from .item import encode_item
 
+from collections.abc import MutableMapping
+from threading import Thread, Condition, RLock
+import traceback
 import tempfile
+import sqlite3
+import hashlib
+import struct
+import mmap
 import logging
 import shutil
 import json
 import gzip
+import lzma
+import zlib
 import time
+import io
 import os
 
 log = logging.getLogger("SHELF")
 
-class CantoShelf():
+# Shelf files start with a header line
+#
+# CANTO-SHELF <version> <codec> <level>
+#
+# followed by compact JSON, compressed with codec. Files without the header
+# are from before it existed, and are always gzip.
+
+# Version 2 files (see write_blocked_shelf_file) compress each top-level key
+# separately so they can be read one at a time, version 3 files (see
+# write_mapped_shelf_file) are uncompressed and split up further so they can
+# be mmap'd.
+
+SHELF_HEADER = "CANTO-SHELF"
+SHELF_VERSION = 3
+
+# Version 1 files end with a CRC32 of everything before it, so a truncated or
+# corrupt file is noticed instead of being mistaken for an old shelf.
+#
+# \nCANTO-SHELF-CRC <crc, 8 hex digits>\n
+#
+# Version 2 and 3 files store a CRC32 for the index and each block instead.
+
+SHELF_TRAILER = "CANTO-SHELF-CRC"
+SHELF_TRAILER_SIZE = len(SHELF_TRAILER) + 11
+
+shelf_codecs = { "none" : 0, "gzip" : 6, "zlib" : 6, "lzma" : 6 }
+
+DEFAULT_SHELF_FORMAT = "gzip"
+
+# Parse a format string like "gzip", "gzip:1", or "none" into (codec, level).
+
+def parse_shelf_format(shelf_format):
+    if ":" in shelf_format:
+        codec, level = shelf_format.split(":", 1)
+        try:
+            level = int(level)
+        except:
+            raise ValueError("Invalid level: %s" % level)
+    else:
+        codec = shelf_format
+        level = None
+
+    if codec not in shelf_codecs:
+        raise ValueError("Unknown codec: %s" % codec)
+
+    if level == None:
+        level = shelf_codecs[codec]
+    elif codec == "none" or level < 0 or level > 9:
+        raise ValueError("Invalid level for %s: %s" % (codec, level))
+
+    return (codec, level)
+
+class ZlibWriter(io.RawIOBase):
+    def __init__(self, fp, level):
+        self.fp = fp
+        self.compressor = zlib.compressobj(level)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.fp.write(self.compressor.compress(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self.fp.write(self.compressor.flush())
+        io.RawIOBase.close(self)
+
+class ChecksumWriter(io.RawIOBase):
+    def __init__(self, fp):
+        self.fp = fp
+        self.crc = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.crc = zlib.crc32(b, self.crc)
+        self.fp.write(b)
+        return len(b)
+
+def write_shelf_file(data, filename, shelf_format):
+    codec, level = shelf_format
+
+    fp = open(filename, "wb")
+    try:
+        sfp = ChecksumWriter(fp)
+
+        header = "%s %d %s %d\n" % (SHELF_HEADER, 1, codec, level)
+        sfp.write(header.encode("UTF-8"))
+
+        if codec == "gzip":
+            cfp = gzip.GzipFile(fileobj=sfp, mode="wb", compresslevel=level)
+        elif codec == "zlib":
+            cfp = ZlibWriter(sfp, level)
+        elif codec == "lzma":
+            cfp = lzma.LZMAFile(sfp, "wb", preset=level)
+        else:
+            cfp = sfp
+
+        tfp = io.TextIOWrapper(cfp, "UTF-8")
+        json.dump(data, tfp, separators=(",",":"), default=encode_item)
+        tfp.detach()
+
+        if cfp != sfp:
+            cfp.close()
+
+        trailer = "\n%s %08x\n" % (SHELF_TRAILER, sfp.crc)
+        fp.write(trailer.encode("UTF-8"))
+
+        fp.flush()
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+
+def compress_block(data, shelf_format):
+    codec, level = shelf_format
+    if codec == "gzip":
+        return gzip.compress(data, level)
+    elif codec == "zlib":
+        return zlib.compress(data, level)
+    elif codec == "lzma":
+        return lzma.compress(data, preset=level)
+    return data
+
+def decompress_block(data, codec):
+    if codec == "gzip":
+        return gzip.decompress(data)
+    elif codec == "zlib":
+        return zlib.decompress(data)
+    elif codec == "lzma":
+        return lzma.decompress(data)
+    elif codec == "none":
+        return data
+    raise Exception("Unknown shelf codec: %s" % codec)
+
+# The attributes of each entry that the index of a version 2 or 3 file keeps
+# for every feed, enough to tag its items and tell when they expire without
+# decoding its block.
+
+summary_attributes = [ "id", "canto_update", "canto-tags", "canto-state" ]
+
+# Return feed contents with only the summary attributes of each entry, or None
+# for anything that isn't feed contents.
+
+def summarize(value):
+    if type(value) != dict or type(value.get("entries", None)) != list:
+        return None
+
+    entries = []
+    for item in value["entries"]:
+        entries.append(dict([ (attr, item[attr])\
+                for attr in summary_attributes if attr in item ]))
+    return { "entries" : entries }
+
+# A top-level value that is still on disk in a version 2 file.
+
+class ShelfBlock():
+    def __init__(self, fp, codec, offset, length, crc, summary):
+        self.fp = fp
+        self.codec = codec
+        self.offset = offset
+        self.length = length
+        self.crc = crc
+        self.summary = summary
+
+    def raw(self):
+        raw = os.pread(self.fp.fileno(), self.length, self.offset)
+        if zlib.crc32(raw) != self.crc:
+            raise Exception("Bad block checksum")
+        return raw
+
+    # Return the block compressed according to shelf_format, only
+    # recompressing if the codec has changed.
+
+    def encode(self, shelf_format):
+        if shelf_format[0] == self.codec:
+            return self.raw()
+        return compress_block(decompress_block(self.raw(), self.codec), shelf_format)
+
+    def load(self):
+        return json.loads(decompress_block(self.raw(), self.codec).decode("UTF-8"))
+
+# Version 2 files are laid out as
+#
+# CANTO-SHELF 2 <codec> <level>
+# <block for each key>
+# <index JSON, { key : [ offset, length, crc, summary ] }>
+# <index offset, 20 digits> <index crc, 8 hex digits>
+#
+# where summary is the output of summarize() for the key's value.
+#
+# Values in data may be ShelfBlocks, which are copied over without being
+# decoded. Returns the index.
+
+BLOCK_TRAILER_SIZE = 31
+
+def write_blocked_shelf_file(data, filename, shelf_format):
+    codec, level = shelf_format
+    index = {}
+
+    fp = open(filename, "wb")
+    try:
+        header = "%s %d %s %d\n" % (SHELF_HEADER, 2, codec, level)
+        fp.write(header.encode("UTF-8"))
+
+        for key, value in data.items():
+            if isinstance(value, ShelfBlock):
+                block = value.encode(shelf_format)
+                summary = value.summary
+            else:
+                block = compress_block(json.dumps(value, separators=(",",":"),
+                    default=encode_item).encode("UTF-8"), shelf_format)
+                summary = summarize(value)
+
+            index[key] = (fp.tell(), len(block), zlib.crc32(block), summary)
+            fp.write(block)
+
+        write_shelf_index(fp, index)
+
+        fp.flush()
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+
+    return index
+
+def write_shelf_index(fp, index):
+    index_offset = fp.tell()
+    index = json.dumps(index, separators=(",",":"),
+            default=encode_item).encode("UTF-8")
+    fp.write(index)
+    fp.write(("\n%020d %08x\n" % (index_offset, zlib.crc32(index))).encode("UTF-8"))
+
+# Version 3 files use the same index and trailer as version 2, but nothing is
+# compressed and a feed's block is
+#
+# { "contents" : <contents without entries>, "keys" : [ attribute, ... ],
+#   "items" : <offset of item table>, "count" : <number of entries> }
+#
+# The item table has an (offset, count) pair for each entry, pointing to its
+# attribute table of (key index, offset, length) for each attribute's JSON
+# value. Anything other than feed contents is stored as { "value" : value }.
+
+# The index points to the whole region written for a key, values and tables
+# followed by the JSON above and its length, so the CRC covers all of it.
+
+MAPPED_ITEM = struct.Struct("<QH")
+MAPPED_ATTR = struct.Struct("<HQI")
+
+# An entry from an mmap'd version 3 file, attributes are decoded when they're
+# used. Changes are kept in overlay (and deleted), the file is never touched.
+
+class MappedItem(MutableMapping):
+    __slots__ = [ "mm", "names", "offset", "count", "overlay", "deleted" ]
+
+    def __init__(self, mm, names, offset, count):
+        self.mm = mm
+        self.names = names
+        self.offset = offset
+        self.count = count
+        self.overlay = None
+        self.deleted = None
+
+    def _attrs(self):
+        for i in range(self.count):
+            yield MAPPED_ATTR.unpack_from(self.mm, self.offset + i * MAPPED_ATTR.size)
+
+    # Return the JSON for key from the file, or None if it's not there or has
+    # been changed since.
+
+    def raw(self, key):
+        if self.overlay and key in self.overlay:
+            return None
+        if self.deleted and key in self.deleted:
+            return None
+
+        for k, offset, length in self._attrs():
+            if self.names[k] == key:
+                return self.mm[offset:offset + length]
+        return None
+
+    # Yield (key, JSON) for every attribute, JSON is None if the attribute has
+    # been changed.
+
+    def raw_items(self):
+        for k, offset, length in self._attrs():
+            key = self.names[k]
+            if self.overlay and key in self.overlay:
+                continue
+            if self.deleted and key in self.deleted:
+                continue
+            yield (key, self.mm[offset:offset + length])
+
+        if self.overlay:
+            for key in self.overlay:
+                yield (key, None)
+
+    def __getitem__(self, key):
+        if self.overlay and key in self.overlay:
+            return self.overlay[key]
+
+        raw = self.raw(key)
+        if raw == None:
+            raise KeyError(key)
+        return json.loads(raw.decode("UTF-8"))
+
+    def __contains__(self, key):
+        if self.overlay and key in self.overlay:
+            return True
+        return self.raw(key) != None
+
+    def __iter__(self):
+        for k, offset, length in self._attrs():
+            key = self.names[k]
+            if self.overlay and key in self.overlay:
+                continue
+            if self.deleted and key in self.deleted:
+                continue
+            yield key
+
+        if self.overlay:
+            for key in self.overlay:
+                yield key
+
+    def __len__(self):
+        return len(list(self.__iter__()))
+
+    def __setitem__(self, key, value):
+        if self.overlay == None:
+            self.overlay = {}
+        self.overlay[key] = value
+
+        if self.deleted:
+            self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        if self.overlay and key in self.overlay:
+            del self.overlay[key]
+
+        if self.deleted == None:
+            self.deleted = set()
+        self.deleted.add(key)
+
+    def copy(self):
+        r = MappedItem(self.mm, self.names, self.offset, self.count)
+        if self.overlay:
+            r.overlay = self.overlay.copy()
+        if self.deleted:
+            r.deleted = self.deleted.copy()
+        return r
+
+    def __repr__(self):
+        return repr(dict(self))
+
+MAPPED_META = struct.Struct("<I")
+
+class MappedBlock():
+    def __init__(self, mm, offset, length, crc, summary):
+        self.mm = mm
+        self.offset = offset
+        self.length = length
+        self.crc = crc
+        self.summary = summary
+
+    def load(self):
+        start = self.offset
+        end = self.offset + self.length
+
+        if zlib.crc32(memoryview(self.mm)[start:end]) != self.crc:
+            raise Exception("Bad block checksum")
+
+        end -= MAPPED_META.size
+        start = end - MAPPED_META.unpack_from(self.mm, end)[0]
+
+        meta = json.loads(self.mm[start:end].decode("UTF-8"))
+        if "value" in meta:
+            return meta["value"]
+
+        contents = meta["contents"]
+        keys = meta["keys"]
+
+        table = self.mm[meta["items"]:meta["items"] + meta["count"] * MAPPED_ITEM.size]
+        contents["entries"] = [ MappedItem(self.mm, keys, offset, count)\
+                for (offset, count) in MAPPED_ITEM.iter_unpack(table) ]
+        return contents
+
+# Write value at the end of fp, returning the (offset, length, crc) of its
+# region. Unchanged attributes of MappedItems are copied without being
+# decoded.
+
+def write_mapped_value(fp, value):
+    start = fp.tell()
+    pos = start
+    chunks = []
+
+    if type(value) != dict or type(value.get("entries", None)) != list:
+        meta = { "value" : value }
+    else:
+        keys = {}
+        tables = []
+
+        for item in value["entries"]:
+            table = []
+
+            if isinstance(item, MappedItem):
+                attrs = item.raw_items()
+            else:
+                attrs = [ (key, json.dumps(value, separators=(",",":")).encode("UTF-8"))\
+                        for key, value in item.items() ]
+
+            for key, raw in attrs:
+                if raw == None:
+                    raw = json.dumps(item[key], separators=(",",":")).encode("UTF-8")
+
+                if key not in keys:
+                    keys[key] = len(keys)
+
+                table.append(MAPPED_ATTR.pack(keys[key], pos, len(raw)))
+                chunks.append(raw)
+                pos += len(raw)
+            tables.append(table)
+
+        items = []
+        for table in tables:
+            items.append(MAPPED_ITEM.pack(pos, len(table)))
+            table = b"".join(table)
+            chunks.append(table)
+            pos += len(table)
+
+        items_offset = pos
+        items = b"".join(items)
+        chunks.append(items)
+        pos += len(items)
+
+        contents = value.copy()
+        del contents["entries"]
+
+        meta = { "contents" : contents,
+                 "keys" : sorted(keys.keys(), key=lambda k: keys[k]),
+                 "items" : items_offset,
+                 "count" : len(tables) }
+
+    meta = json.dumps(meta, separators=(",",":")).encode("UTF-8")
+    chunks.append(meta)
+    chunks.append(MAPPED_META.pack(len(meta)))
+
+    region = b"".join(chunks)
+    fp.write(region)
+    return (start, len(region), zlib.crc32(region))
+
+def write_mapped_shelf_file(data, filename):
+    index = {}
+
+    fp = open(filename, "wb")
+    try:
+        header = "%s %d none 0\n" % (SHELF_HEADER, 3)
+        fp.write(header.encode("UTF-8"))
+
+        for key, value in data.items():
+            if isinstance(value, MappedBlock):
+                summary = value.summary
+                value = value.load()
+            else:
+                summary = summarize(value)
+            index[key] = write_mapped_value(fp, value) + (summary,)
+
+        write_shelf_index(fp, index)
+
+        fp.flush()
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+
+    return index
+
+# Returns (version, codec), leaving fp at the start of the data.
+
+def read_shelf_header(fp):
+    header = fp.read(len(SHELF_HEADER))
+    if header != SHELF_HEADER.encode("UTF-8"):
+        fp.seek(0)
+        return (0, "gzip")
+
+    header = fp.readline().decode("UTF-8").split()
+    if int(header[0]) > SHELF_VERSION:
+        raise Exception("Unknown shelf version: %s" % header[0])
+    return (int(header[0]), header[1])
+
+# Returns { key : ShelfBlock } for a version 2 file. The blocks read from fp,
+# so it has to stay open while they're in use.
+
+def read_shelf_blocks(fp, codec):
+    fp.seek(-BLOCK_TRAILER_SIZE, os.SEEK_END)
+    end = fp.tell()
+    index_offset, index_crc = fp.read().decode("UTF-8").split()
+
+    fp.seek(int(index_offset))
+    index = fp.read(end - int(index_offset))
+
+    if zlib.crc32(index) != int(index_crc, 16):
+        raise Exception("Bad index checksum")
+
+    index = json.loads(index.decode("UTF-8"))
+
+    r = {}
+    for key, (offset, length, crc, summary) in index.items():
+        r[key] = ShelfBlock(fp, codec, offset, length, crc, summary)
+    return r
+
+# Returns { key : MappedBlock } for a version 3 file. The file can be closed,
+# the blocks keep it mapped.
+
+def read_mapped_blocks(fp):
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    r = {}
+    blocks = read_shelf_blocks(fp, "none")
+    for key in blocks:
+        r[key] = MappedBlock(mm, blocks[key].offset, blocks[key].length,
+                blocks[key].crc, blocks[key].summary)
+    return r
+
+def read_shelf_file(filename):
+    fp = open(filename, "rb")
+    try:
+        version, codec = read_shelf_header(fp)
+
+        if version == 2:
+            blocks = read_shelf_blocks(fp, codec)
+            return dict([ (key, blocks[key].load()) for key in blocks ])
+
+        if version == 3:
+            blocks = read_mapped_blocks(fp)
+
+            r = {}
+            for key in blocks:
+                r[key] = blocks[key].load()
+                if type(r[key]) == dict and "entries" in r[key]:
+                    r[key]["entries"] = [ dict(item) for item in r[key]["entries"] ]
+            return r
+
+        payload = read_shelf_payload(fp, version)
+        return json.loads(decompress_block(payload, codec).decode("UTF-8"))
+    finally:
+        fp.close()
+
+# Return the (still compressed) data of a version 0 or 1 file, after checking
+# the trailer of a version 1 file.
+
+def read_shelf_payload(fp, version):
+    body = fp.tell()
+    fp.seek(0)
+    raw = fp.read()
+
+    if version == 1:
+        trailer = raw[-SHELF_TRAILER_SIZE:]
+        if not trailer.startswith(("\n" + SHELF_TRAILER).encode("UTF-8")):
+            raise Exception("Missing shelf trailer")
+
+        raw = raw[:-SHELF_TRAILER_SIZE]
+        if zlib.crc32(raw) != int(trailer[-9:-1], 16):
+            raise Exception("Bad shelf checksum")
+
+    return raw[body:]
+
+# Check a shelf file's checksums (for version 2 and 3, only the index) without
+# decoding it.
+
+def check_shelf_file(filename):
+    fp = open(filename, "rb")
+    try:
+        version, codec = read_shelf_header(fp)
+        if version >= 2:
+            read_shelf_blocks(fp, codec)
+        else:
+            read_shelf_payload(fp, version)
+    finally:
+        fp.close()
+
+def fsync_dir(dirname):
+    fd = os.open(dirname or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Move tmpname over filename, keeping the previous generation of filename as
+# filename.bak, and make sure the rename is on disk before returning.
+
+def replace_shelf_file(tmpname, filename, keep_previous):
+    if keep_previous and os.path.exists(filename):
+        backup = filename + ".bak"
+        if os.path.exists(backup):
+            os.unlink(backup)
+        try:
+            os.link(filename, backup)
+        except OSError:
+            shutil.copy2(filename, backup)
+
+    os.replace(tmpname, filename)
+    fsync_dir(os.path.dirname(filename))
+
+# Once a shelf is dirty, sync() waits until it's gone SYNC_DEBOUNCE seconds
+# without changes before writing, so a burst of changes (like a client marking
+# hundreds of items read) is only written once. A shelf that keeps changing is
+# still written SYNC_MAX_LATENCY seconds after it first became dirty.
+
+SYNC_DEBOUNCE = 5
+SYNC_MAX_LATENCY = 60
+
+# The writer thread performs the actual disk writes for a shelf, so sync() only
+# needs the feed locks long enough to take a snapshot of what's changed.
+
+# Jobs are run in the order they're submitted. A job submitted with a key
+# replaces any job with the same key that hasn't started yet, so a burst of
+# syncs only writes the latest snapshot. If a job raises, its failed callback
+# (if any) is called from the writer thread.
+
+class CantoShelfWriter(Thread):
+    def __init__(self):
+        Thread.__init__(self, name = "Shelf writer")
+        self.daemon = True
+
+        self.cond = Condition()
+        self.jobs = []
+        self.busy = False
+
+        self.written = 0
+        self.coalesced = 0
+
+    def submit(self, key, target, args, failed=None):
+        with self.cond:
+            if key != None:
+                jobs = [ j for j in self.jobs if j[0] != key ]
+                self.coalesced += len(self.jobs) - len(jobs)
+                self.jobs = jobs
+
+            self.jobs.append((key, target, args, failed))
+            self.cond.notify_all()
+
+    # Block until every submitted job has been run.
+
+    def wait(self):
+        with self.cond:
+            while self.jobs or self.busy:
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                key, target, args, failed = self.jobs.pop(0)
+                self.busy = True
+
+            try:
+                target(*args)
+                self.written += 1
+            except Exception as e:
+                log.error("Shelf write failed: %s", e)
+                log.error(traceback.format_exc())
+                if failed:
+                    failed()
+
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+# The archive is a cold store for items that have been moved out of the shelf,
+# in filename.archive. It's only ever appended to, one gzip member per batch of
+# items, each a line of JSON
+#
+# { "feed" : key, "item" : item }
+#
+# and is only read when something asks for archived items.
+
+class CantoArchive():
     def __init__(self, filename):
         self.filename = filename
 
+    def append(self, name, items):
+        data = "".join([ json.dumps({ "feed" : name, "item" : dict(item) },
+            separators=(",",":")) + "\n" for item in items ])
+
+        fp = open(self.filename, "ab")
+        try:
+            fp.write(gzip.compress(data.encode("UTF-8")))
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+
+        log.debug("Archived %d items from %s", len(items), name)
+
+    # Return the archived items for name, if an item was archived more than
+    # once the latest copy wins.
+
+    def get(self, name):
+        if not os.path.exists(self.filename):
+            return []
+
+        r = {}
+
+        fp = gzip.open(self.filename, "rt", encoding="UTF-8")
+        try:
+            for line in fp:
+                record = json.loads(line)
+                if record["feed"] == name:
+                    r[record["item"]["id"]] = record["item"]
+        except Exception as e:
+            # A batch that never made it to disk.
+
+            log.error("Failed to read all of %s: %s", self.filename, e)
+        finally:
+            fp.close()
+
+        return list(r.values())
+
+class CantoShelf():
+    def __init__(self, filename, shelf_format=DEFAULT_SHELF_FORMAT):
+        self.filename = filename
+        self.shelf_format = parse_shelf_format(shelf_format)
+
         self.cache = {}
+        self.archive = CantoArchive(filename + ".archive")
+
+        # { name : (entries, { item id : position in entries }) }, good for as
+        # long as name still holds that same entries list.
+
+        self.positions = {}
+
+        # { name : contents } that update_items copied and nothing else has a
+        # reference to yet, so it can keep changing them in place. Good for as
+        # long as name still holds those same contents.
+
+        self.owned = {}
+
+        # Top-level keys changed since the last sync, and when the first and
+        # latest of those changes happened.
+
+        self.dirty = []
+        self.dirty_since = None
+        self.last_change = None
+
+        # Keys whose writes failed in the background, to be marked dirty again
+        # by the next sync. Only ever appended to by the writer thread.
+
+        self.failed = []
+
+        self.syncs_performed = 0
+        self.syncs_deferred = 0
+        self.syncs_skipped = 0
+
+        self.writer = CantoShelfWriter()
+        self.writer.start()
 
         self.open()
 
@@ -36,19 +802,23 @@ class CantoShelf():
             if ctrl_field not in self.cache["control"]:
                 self.cache["control"][ctrl_field] = 0
 
-    @wlock_feeds
-    def open(self):
-        call_hook("daemon_db_open", [self.filename])
+    def load_snapshot(self):
+        backup = self.filename + ".bak"
 
-        if not os.path.exists(self.filename):
-            fp = gzip.open(self.filename, "wt", 9, "UTF-8")
-            json.dump(self.cache, fp)
-            fp.close()
+        if not os.path.exists(self.filename) and not os.path.exists(backup):
+            self.write_snapshot(self.cache, self.filename)
+        elif not os.path.exists(self.filename):
+            self.recover_snapshot()
         else:
-            fp = gzip.open(self.filename, "rt", 9, "UTF-8")
             try:
-                self.cache = json.load(fp)
-            except:
+                self.cache = read_shelf_file(self.filename)
+            except Exception as e:
+                log.error("Failed to load %s: %s", self.filename, e)
+
+                if os.path.exists(backup):
+                    self.recover_snapshot()
+                    return
+
                 log.info("Failed to JSON load, old shelf?")
                 try:
                     import shelve
@@ -69,13 +839,71 @@ class CantoShelf():
                     self.cache = {}
                 else:
                     log.info("Migrated old shelf")
-            finally:
-                fp.close()
+
+    # Fall back to the previous generation of the shelf. The bad file is moved
+    # aside, so the next sync doesn't replace the backup with it.
+
+    def recover_snapshot(self):
+        backup = self.filename + ".bak"
+
+        if os.path.exists(self.filename):
+            os.replace(self.filename, self.filename + ".corrupt")
+            log.error("Moved bad shelf to %s.corrupt", self.filename)
+
+        try:
+            self.cache = read_shelf_file(backup)
+        except Exception as e:
+            log.error("Failed to load %s: %s", backup, e)
+            log.error("Carrying on with empty shelf")
+            self.cache = {}
+            return
+
+        log.info("Recovered previous generation from %s", backup)
+
+        for name in self.cache:
+            self.mark_dirty(name)
+
+    # Write a full copy of data to filename, via a tempfile so that filename
+    # is never partially written. The tempfile is checked before it replaces
+    # filename, and the previous generation of the shelf itself is kept.
+
+    def write_snapshot(self, data, filename):
+        f, tmpname = tempfile.mkstemp(None, "feeds", os.path.dirname(filename))
+        os.close(f)
+
+        write_shelf_file(data, tmpname, self.shelf_format)
+        check_shelf_file(tmpname)
+
+        log.debug("Written tempfile.")
+
+        replace_shelf_file(tmpname, filename, filename == self.filename)
+
+    @wlock_feeds
+    def open(self):
+        call_hook("daemon_db_open", [self.filename])
+
+        self.load_snapshot()
 
         self.check_control_data()
 
+    def mark_dirty(self, name):
+        now = time.monotonic()
+        if not self.dirty:
+            self.dirty_since = now
+        self.last_change = now
+
+        if name not in self.dirty:
+            self.dirty.append(name)
+
+    def mark_clean(self):
+        self.dirty = []
+        self.dirty_since = None
+        self.last_change = None
+
     def __setitem__(self, name, value):
         self.cache[name] = value
+        self.positions.pop(name, None)
+        self.mark_dirty(name)
         self.update_mod()
 
     def __getitem__(self, name):
@@ -87,8 +915,83 @@ class CantoShelf():
     def __delitem__(self, name):
         if name in self.cache:
             del self.cache[name]
+        self.positions.pop(name, None)
+        self.mark_dirty(name)
         self.update_mod()
 
+    # Return the entries stored under name, and { item id : position } for
+    # them. The positions are only rebuilt when the entries are replaced, so
+    # item lookups don't have to walk the whole feed.
+
+    def item_positions(self, name):
+        entries = self[name]["entries"]
+
+        if name in self.positions and self.positions[name][0] is entries:
+            return self.positions[name]
+
+        positions = {}
+        for i, item in enumerate(entries):
+            positions[item["id"]] = i
+
+        self.positions[name] = (entries, positions)
+        return self.positions[name]
+
+    # Return the contents stored under name, or a stand-in with at least the
+    # summary_attributes of each entry, if that's cheaper. Only good for
+    # reading.
+
+    def get_summary(self, name):
+        return self[name]
+
+    # Return { item id : entry } for the given ids of the entries stored
+    # under name.
+
+    def get_items(self, name, ids):
+        entries, positions = self.item_positions(name)
+        r = {}
+        for id in ids:
+            if id in positions:
+                r[id] = entries[positions[id]]
+        return r
+
+    # Update attributes of the entries stored under name. Changes is
+    # { item id : { attribute : value } }, the updated entries are returned.
+
+    # Entries are replaced rather than modified in place so that a copy of
+    # self.cache taken earlier is unaffected. The contents and entries list
+    # are only copied once after they've been handed out (by snapshot() or a
+    # writer job), until then later updates only cost the items they touch.
+    # Positions don't move, so they carry over to the new entries list.
+
+    def update_items(self, name, changes):
+        entries, positions = self.item_positions(name)
+
+        if self.owned.get(name) is self[name]:
+            contents = self[name]
+        else:
+            contents = self[name].copy()
+            entries = entries[:]
+            contents["entries"] = entries
+            self.cache[name] = contents
+            self.positions[name] = (entries, positions)
+            self.owned[name] = contents
+
+        updated = []
+
+        for id in changes:
+            if id not in positions:
+                continue
+
+            i = positions[id]
+            item = entries[i].copy()
+            item.update(changes[id])
+            entries[i] = item
+            updated.append(item)
+
+        if updated:
+            self.mark_dirty(name)
+        return updated
+
     def update_umod(self):
         if "control" not in self.cache:
             self.cache["control"] = self.cache['control']
@@ -96,6 +999,7 @@ class CantoShelf():
         ts = int(time.mktime(time.gmtime()))
         self.cache["control"]["canto-user-modified"] = ts
         self.cache["control"]["canto-modified"] = ts
+        self.mark_dirty("control")
 
     def update_mod(self):
         if "control" not in self.cache:
@@ -103,31 +1007,933 @@ class CantoShelf():
 
         ts = int(time.mktime(time.gmtime()))
         self.cache["control"]["canto-modified"] = ts
+        self.mark_dirty("control")
+
+    # Entries and feed contents are replaced rather than modified (see
+    # update_items), so a shallow copy of the cache is a consistent snapshot.
+    # Control data is modified in place, so it's copied.
+
+    def snapshot(self):
+        snapshot = self.cache.copy()
+        snapshot["control"] = self.cache["control"].copy()
+        self.owned = {}
+        return snapshot
+
+    # Move items from name to the archive. The caller removes them from the
+    # shelf, but since the archive is written by the writer they always reach
+    # the archive before a snapshot without them.
+
+    def archive_items(self, name, items):
+        self.writer.submit(None, self.archive.append, (name, items))
+
+    # Archiving happens in the background, so let any pending batches hit the
+    # disk before reading them back.
+
+    def get_archived(self, name):
+        self.writer.wait()
+        return self.archive.get(name)
+
+    # Return a list of (key, target, args, names) writer jobs that will bring
+    # the disk up to date with the shelf, where names are the dirty keys that
+    # job writes out.
 
     @wlock_feeds
-    def sync(self):
+    def prepare_sync(self):
 
         # If we get a sync after we're closed, or before we're open
         # just ignore it.
 
         if self.cache == {}:
-            return
+            return []
 
-        f, tmpname = tempfile.mkstemp(None, "feeds", os.path.dirname(self.filename))
-        os.close(f)
+        snapshot = self.snapshot()
 
-        fp = gzip.open(tmpname, "wt", 9, "UTF-8")
-        json.dump(self.cache, fp, indent=4, sort_keys=True)
-        fp.close()
+        names = self.dirty
+        self.mark_clean()
+        return [ (self.filename, self._write, (snapshot,), names) ]
 
-        log.debug("Written tempfile.")
+    def _write(self, snapshot):
+        self.write_snapshot(snapshot, self.filename)
+        log.debug("Synced.")
 
-        shutil.move(tmpname, self.filename)
+    def sync_due(self):
+        now = time.monotonic()
+        return now - self.last_change >= SYNC_DEBOUNCE or\
+                now - self.dirty_since >= SYNC_MAX_LATENCY
 
-        log.debug("Synced.")
+    # Queue the changes to be written in the background. Unless force is set,
+    # this does nothing until sync_due().
 
-    def close(self):
-        log.debug("Closing.")
-        self.sync()
+    def sync(self, force=False):
+        if self.failed:
+            self.redirty_failed()
+
+        if not self.dirty:
+            self.syncs_skipped += 1
+            return
+
+        if not force and not self.sync_due():
+            self.syncs_deferred += 1
+            return
+
+        for key, target, args, names in self.prepare_sync():
+            self.writer.submit(key, target, args,
+                    lambda names=names: self.failed.extend(names))
+
+        self.syncs_performed += 1
+
+    # Mark keys that didn't make it to disk dirty again, so they're written by
+    # the next sync instead of being lost with the write that failed.
+
+    @wlock_feeds
+    def redirty_failed(self):
+        while self.failed:
+            self.mark_dirty(self.failed.pop(0))
+
+    # Sync, and wait for the changes to hit the disk.
+
+    def flush(self):
+        self.sync(True)
+        self.writer.wait()
+
+    def stats(self):
+        return { "performed" : self.syncs_performed,
+                 "deferred" : self.syncs_deferred,
+                 "skipped" : self.syncs_skipped,
+                 "coalesced" : self.writer.coalesced,
+                 "written" : self.writer.written }
+
+    # Write a complete, standalone copy of the shelf to path.
+
+    @wlock_feeds
+    def export(self, path):
+        self.write_snapshot(self.snapshot(), path)
+
+    # Replace the shelf's contents with a file written by export().
+
+    @wlock_feeds
+    def replace(self, path):
+        self.close()
+        shutil.move(path, self.filename)
+        self.open()
+
+    def close(self):
+        log.debug("Closing.")
+        self.flush()
         self.cache = {}
+        self.positions = {}
+        self.owned = {}
+        self.failed = []
+        self.mark_clean()
         call_hook("daemon_db_close", [self.filename])
+
+# Journal size (in bytes) that will trigger compaction into the snapshot.
+
+JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
+
+# The journaled shelf keeps the full snapshot in self.filename, but sync() only
+# appends the changes made since the last sync to filename.journal, one JSON
+# record per line:
+#
+# { "set" : key, "value" : value }
+# { "del" : key }
+# { "items" : key, "changes" : { item id : { attribute : value } } }
+#
+# Each record only overwrites state, so replaying a record that is already
+# reflected in the snapshot is harmless. Compaction is run by the writer after
+# every record in the snapshot has been appended, so it can write the snapshot
+# and then truncate the journal without losing anything if we crash in
+# between.
+
+class CantoJournalShelf(CantoShelf):
+    def __init__(self, filename, **kwargs):
+        self.journal_name = filename + ".journal"
+
+        self.journal = None
+        self.journal_size = 0
+        self.compacting = False
+
+        # Keys with a new value to be written, and per-item changes for keys
+        # without one.
+
+        self.pending = []
+        self.pending_items = {}
+
+        CantoShelf.__init__(self, filename, **kwargs)
+
+    def replay(self, journal_name):
+        log.debug("Replaying %s", journal_name)
+
+        fp = open(journal_name, "r", encoding="UTF-8")
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except:
+                # A torn write at the end of the journal, anything after this
+                # never made it to disk.
+
+                log.error("Discarding corrupt journal record in %s", journal_name)
+                break
+
+            if "set" in record:
+                self.cache[record["set"]] = record["value"]
+            elif "del" in record:
+                if record["del"] in self.cache:
+                    del self.cache[record["del"]]
+            elif "items" in record:
+                if record["items"] not in self.cache:
+                    continue
+                for item in self.cache[record["items"]]["entries"]:
+                    if item["id"] in record["changes"]:
+                        item.update(record["changes"][item["id"]])
+        fp.close()
+
+    @wlock_feeds
+    def open(self):
+        call_hook("daemon_db_open", [self.filename])
+
+        self.load_snapshot()
+
+        replayed = False
+        if os.path.exists(self.journal_name) and os.path.getsize(self.journal_name):
+            self.replay(self.journal_name)
+            replayed = True
+
+        self.check_control_data()
+
+        # Fold what we replayed into the snapshot so we start with an empty
+        # journal.
+
+        if replayed:
+            self.write_snapshot(self.cache, self.filename)
+
+        self.reset_journal()
+
+    def reset_journal(self):
+        if self.journal:
+            self.journal.close()
+
+        self.pending = []
+        self.pending_items = {}
+
+        self.journal = open(self.journal_name, "w", encoding="UTF-8")
+        self.journal_size = 0
+
+    def _pend(self, name):
+        if name not in self.pending:
+            self.pending.append(name)
+        if name in self.pending_items:
+            del self.pending_items[name]
+
+    def __setitem__(self, name, value):
+        CantoShelf.__setitem__(self, name, value)
+        self._pend(name)
+
+    def __delitem__(self, name):
+        CantoShelf.__delitem__(self, name)
+        self._pend(name)
+
+    def update_items(self, name, changes):
+        updated = CantoShelf.update_items(self, name, changes)
+
+        if name not in self.pending:
+            if name not in self.pending_items:
+                self.pending_items[name] = {}
+            pending = self.pending_items[name]
+
+            for item in updated:
+                if item["id"] not in pending:
+                    pending[item["id"]] = {}
+                pending[item["id"]].update(changes[item["id"]])
+
+        return updated
+
+    def _records(self):
+        records = []
+
+        # Control data is modified in place, so always note it.
+
+        self._pend("control")
+
+        for name in self.pending:
+            if name == "control":
+                records.append({ "set" : name, "value" : self.cache[name].copy() })
+            elif name in self.cache:
+                records.append({ "set" : name, "value" : self.cache[name] })
+                self.owned.pop(name, None)
+            else:
+                records.append({ "del" : name })
+
+        for name in self.pending_items:
+            records.append({ "items" : name,
+                "changes" : self.pending_items[name] })
+
+        self.pending = []
+        self.pending_items = {}
+
+        return records
+
+    # Writer jobs, these are the only things that touch the journal once the
+    # shelf is open.
+
+    def _append(self, records):
+        try:
+            for record in records:
+                self.journal.write(json.dumps(record, separators=(",",":"),
+                    default=encode_item) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except:
+            # We can't trust the journal anymore, so get the next sync to
+            # write everything into a snapshot.
+
+            self.journal_size = JOURNAL_COMPACT_SIZE
+            raise
+
+        self.journal_size = self.journal.tell()
+        log.debug("Journaled.")
+
+    def _compact(self, snapshot):
+        try:
+            self.write_snapshot(snapshot, self.filename)
+            self.journal.truncate(0)
+            self.journal.seek(0)
+            self.journal_size = 0
+            log.debug("Compacted.")
+        finally:
+            self.compacting = False
+
+    @wlock_feeds
+    def prepare_sync(self):
+        if self.cache == {}:
+            return []
+
+        jobs = []
+        names = self.dirty
+
+        # A failed _append leaves journal_size past the limit, so marking its
+        # names dirty again is enough to get them into the next compaction.
+
+        if self.pending or self.pending_items:
+            jobs.append((None, self._append, (self._records(),), names))
+
+        if not self.compacting and self.journal_size >= JOURNAL_COMPACT_SIZE:
+            self.compacting = True
+            jobs.append((None, self._compact, (self.snapshot(),), names))
+
+        self.mark_clean()
+        return jobs
+
+    # Write out the full snapshot and empty the journal.
+
+    @wlock_feeds
+    def compact(self):
+        self.writer.wait()
+        self.write_snapshot(self.cache, self.filename)
+        self.reset_journal()
+        self.mark_clean()
+
+    def close(self):
+        log.debug("Closing.")
+        if self.cache != {}:
+            self.compact()
+            self.journal.close()
+            self.journal = None
+        self.cache = {}
+        self.positions = {}
+        self.owned = {}
+        self.failed = []
+        call_hook("daemon_db_close", [self.filename])
+
+# The lazy shelf uses the version 2 format, and only reads the index and the
+# control data when it's opened. Each feed's contents are read the first time
+# they're used, and sync() copies the blocks of feeds that were never read
+# straight from the old file.
+
+class CantoLazyShelf(CantoShelf):
+    block_version = 2
+
+    def __init__(self, filename, **kwargs):
+        self.blocks = {}
+        self.load_lock = RLock()
+
+        CantoShelf.__init__(self, filename, **kwargs)
+
+    def read_blocks(self, fp, codec):
+        return read_shelf_blocks(fp, codec)
+
+    def write_blocks(self, data, filename):
+        return write_blocked_shelf_file(data, filename, self.shelf_format)
+
+    @wlock_feeds
+    def open(self):
+        call_hook("daemon_db_open", [self.filename])
+
+        self.cache = {}
+        self.blocks = {}
+
+        blocks = None
+        if os.path.exists(self.filename):
+            try:
+                fp = open(self.filename, "rb")
+                version, codec = read_shelf_header(fp)
+                if version == self.block_version:
+                    blocks = self.read_blocks(fp, codec)
+                else:
+                    fp.close()
+            except Exception as e:
+                log.error("Failed to read shelf index: %s", e)
+
+        # Anything else gets converted on the next sync.
+
+        if blocks == None:
+            self.load_snapshot()
+            for name in self.cache:
+                self.mark_dirty(name)
+        else:
+            self.blocks = blocks
+            if "control" in self.blocks:
+                self.cache["control"] = self.blocks.pop("control").load()
+
+        self.check_control_data()
+
+        log.debug("Opened with %d feeds on disk.", len(self.blocks))
+
+    def write_snapshot(self, data, filename):
+        f, tmpname = tempfile.mkstemp(None, "feeds", os.path.dirname(filename))
+        os.close(f)
+
+        self.write_blocks(data, tmpname)
+        check_shelf_file(tmpname)
+
+        log.debug("Written tempfile.")
+
+        replace_shelf_file(tmpname, filename, filename == self.filename)
+
+    # Point the blocks that still haven't been read at the file we just wrote,
+    # so the old one can go away. Returns the new blocks.
+
+    def _write(self, snapshot):
+        self.write_snapshot(snapshot, self.filename)
+
+        fp = open(self.filename, "rb")
+        version, codec = read_shelf_header(fp)
+        blocks = self.read_blocks(fp, codec)
+
+        with self.load_lock:
+            for name in self.blocks:
+                self.blocks[name] = blocks[name]
+
+        log.debug("Synced.")
+        return blocks
+
+    def __getitem__(self, name):
+        if name in self.cache:
+            return self.cache[name]
+
+        with self.load_lock:
+            if name not in self.cache:
+                block = self.blocks[name]
+                try:
+                    self.cache[name] = block.load()
+                except Exception as e:
+                    log.error("Failed to load %s: %s", name, e)
+                    self.cache[name] = self.recover_block(name)
+                    self.mark_dirty(name)
+
+                del self.blocks[name]
+                log.debug("Loaded %s", name)
+            return self.cache[name]
+
+    # Feeds that haven't been read yet are summarized in the index, so there's
+    # no need to read them.
+
+    def get_summary(self, name):
+        with self.load_lock:
+            if name in self.blocks and self.blocks[name].summary != None:
+                summary = self.blocks[name].summary
+                return { "entries" : [ item.copy() for item in summary["entries"] ] }
+        return self[name]
+
+    # Fall back to the previous generation's copy of a single bad block.
+
+    def recover_block(self, name):
+        try:
+            fp = open(self.filename + ".bak", "rb")
+            version, codec = read_shelf_header(fp)
+            if version != self.block_version:
+                raise Exception("Backup is version %d" % version)
+            value = self.read_blocks(fp, codec)[name].load()
+        except Exception as e:
+            log.error("Failed to recover %s: %s", name, e)
+            log.error("Carrying on with empty %s", name)
+            return { "entries" : [] }
+
+        log.info("Recovered %s from previous generation", name)
+        return value
+
+    def __contains__(self, name):
+        return name in self.cache or name in self.blocks
+
+    # Hold load_lock through the cache change too, or the mapped shelf's writer
+    # can move the old value back into blocks in between.
+
+    def __setitem__(self, name, value):
+        with self.load_lock:
+            if name in self.blocks:
+                del self.blocks[name]
+            CantoShelf.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        with self.load_lock:
+            if name in self.blocks:
+                del self.blocks[name]
+            CantoShelf.__delitem__(self, name)
+
+    # Anything in the cache is newer than its block.
+
+    def snapshot(self):
+        with self.load_lock:
+            snapshot = self.blocks.copy()
+        snapshot.update(CantoShelf.snapshot(self))
+        return snapshot
+
+    def close(self):
+        CantoShelf.close(self)
+        self.blocks = {}
+
+# The mapped shelf keeps a version 3 file mmap'd, so each entry is a
+# MappedItem that only decodes the attributes that are actually read. Feeds
+# that haven't changed since a sync are dropped back to blocks of the new
+# file, so we're not left holding onto the old one.
+
+class CantoMappedShelf(CantoLazyShelf):
+    block_version = 3
+
+    def read_blocks(self, fp, codec):
+        return read_mapped_blocks(fp)
+
+    def write_blocks(self, data, filename):
+        return write_mapped_shelf_file(data, filename)
+
+    def _write(self, snapshot):
+        blocks = CantoLazyShelf._write(self, snapshot)
+
+        with self.load_lock:
+            for name in snapshot:
+                if name == "control" or name not in self.cache:
+                    continue
+                if self.cache[name] is snapshot[name]:
+                    del self.cache[name]
+                    self.positions.pop(name, None)
+                    self.blocks[name] = blocks[name]
+
+        return blocks
+
+# The sharded shelf stores each top-level key (feed URLs, and "control") in its
+# own file in the filename.d directory, so a sync only has to write out the
+# feeds that actually changed since the last one.
+
+class CantoShardedShelf(CantoShelf):
+    def __init__(self, filename, **kwargs):
+        self.shard_dir = filename + ".d"
+
+        CantoShelf.__init__(self, filename, **kwargs)
+
+    def shard_name(self, name):
+        h = hashlib.sha1(name.encode("UTF-8")).hexdigest()
+        return self.shard_dir + "/" + h
+
+    def read_shard(self, shard):
+        d = read_shelf_file(shard)
+        return d["key"], d["value"]
+
+    @wlock_feeds
+    def open(self):
+        call_hook("daemon_db_open", [self.filename])
+
+        self.cache = {}
+        self.mark_clean()
+
+        if not os.path.exists(self.shard_dir):
+            os.mkdir(self.shard_dir)
+
+            # Migrate a monolithic shelf.
+
+            if os.path.exists(self.filename):
+                self.load_snapshot()
+                for name in self.cache:
+                    self.mark_dirty(name)
+                log.info("Migrating %s to %s", self.filename, self.shard_dir)
+
+        for fname in os.listdir(self.shard_dir):
+
+            # Leftover from a write that never finished.
+
+            if fname.startswith("feeds"):
+                os.unlink(self.shard_dir + "/" + fname)
+                continue
+
+            try:
+                name, value = self.read_shard(self.shard_dir + "/" + fname)
+            except Exception as e:
+                log.error("Failed to read shard %s: %s", fname, e)
+                continue
+            self.cache[name] = value
+
+        self.check_control_data()
+
+        if self.dirty:
+            self.flush()
+            if os.path.exists(self.filename):
+                os.rename(self.filename, self.filename + ".old")
+
+    def _write_shard(self, name, value, shard):
+        self.write_snapshot({ "key" : name, "value" : value }, shard)
+        log.debug("Synced shard for %s", name)
+
+    def _remove_shard(self, shard):
+        if os.path.exists(shard):
+            os.unlink(shard)
+
+    # Each shard is its own job, so repeated syncs of a busy feed only write
+    # its latest value.
+
+    @wlock_feeds
+    def prepare_sync(self):
+        if self.cache == {}:
+            return []
+
+        jobs = []
+        for name in self.dirty:
+            shard = self.shard_name(name)
+            if name == "control":
+                jobs.append((shard, self._write_shard,
+                    (name, self.cache[name].copy(), shard), [ name ]))
+            elif name in self.cache:
+                jobs.append((shard, self._write_shard,
+                    (name, self.cache[name], shard), [ name ]))
+                self.owned.pop(name, None)
+            else:
+                jobs.append((shard, self._remove_shard, (shard,), [ name ]))
+
+        self.mark_clean()
+        return jobs
+
+    @wlock_feeds
+    def replace(self, path):
+        self.close()
+
+        for fname in os.listdir(self.shard_dir):
+            os.unlink(self.shard_dir + "/" + fname)
+        os.rmdir(self.shard_dir)
+
+        # With the shard directory gone, open() will migrate path.
+
+        shutil.move(path, self.filename)
+        self.open()
+
+# The SQLite shelf stores each entry as a row keyed by (feed URL, item id) so
+# get_items() and update_items() are indexed lookups, and keep_time expiry can
+# be done with a range query on canto_update instead of loading the feed.
+
+# Entries are written to the database as they change, sync() just commits.
+
+SQLITE_SCHEMA = [
+"CREATE TABLE IF NOT EXISTS shelf (key TEXT PRIMARY KEY, value TEXT)",
+"CREATE TABLE IF NOT EXISTS items (url TEXT, id TEXT, position INTEGER,\
+        canto_update REAL, canto_state TEXT, item TEXT, PRIMARY KEY (url, id))",
+"CREATE INDEX IF NOT EXISTS items_update ON items (url, canto_update)",
+"CREATE INDEX IF NOT EXISTS items_state ON items (url, canto_state)",
+]
+
+# Keep IN (...) lists under SQLite's variable limit.
+
+SQLITE_CHUNK = 500
+
+class CantoSQLiteShelf(CantoShelf):
+    def __init__(self, filename, **kwargs):
+        self.db_name = filename + ".db"
+        self.db = None
+        self.db_lock = RLock()
+
+        CantoShelf.__init__(self, filename, **kwargs)
+
+    @wlock_feeds
+    def open(self):
+        call_hook("daemon_db_open", [self.filename])
+
+        migrate = not os.path.exists(self.db_name) and\
+                os.path.exists(self.filename)
+
+        self.db = sqlite3.connect(self.db_name, check_same_thread=False)
+        for statement in SQLITE_SCHEMA:
+            self.db.execute(statement)
+
+        self.cache = {}
+
+        # Only the control data is kept in memory.
+
+        if migrate:
+            log.info("Migrating %s to %s", self.filename, self.db_name)
+            self.load_snapshot()
+
+            old = self.cache
+            self.cache = {}
+            if "control" in old:
+                self.cache["control"] = old["control"]
+            self.check_control_data()
+
+            for name in old:
+                if name != "control":
+                    self[name] = old[name]
+        else:
+            row = self.db.execute("SELECT value FROM shelf WHERE key = ?",
+                    ("control",)).fetchone()
+            if row:
+                self.cache["control"] = json.loads(row[0])
+
+        self.check_control_data()
+
+        if migrate:
+            self.flush()
+            if os.path.exists(self.filename):
+                os.rename(self.filename, self.filename + ".old")
+
+    def _item_row(self, name, position, item):
+        state = None
+        if "canto-state" in item:
+            state = json.dumps(item["canto-state"])
+
+        update = None
+        if "canto_update" in item:
+            update = item["canto_update"]
+
+        return (name, item["id"], position, update, state,
+                json.dumps(item, default=encode_item))
+
+    def __setitem__(self, name, value):
+        if name == "control":
+            self.cache[name] = value
+            return
+
+        # Feed contents are stored with a placeholder for the entries, which
+        # go in the items table.
+
+        entries = []
+        if type(value) == dict and "entries" in value:
+            entries = value["entries"]
+            value = value.copy()
+            value["entries"] = []
+
+        with self.db_lock:
+            self.db.execute("INSERT OR REPLACE INTO shelf VALUES (?, ?)",
+                    (name, json.dumps(value)))
+            self.db.execute("DELETE FROM items WHERE url = ?", (name,))
+            self.db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)",
+                    [ self._item_row(name, i, item) for (i, item) in enumerate(entries) ])
+
+        self.update_mod()
+
+    def __getitem__(self, name):
+        if name == "control":
+            return self.cache[name]
+
+        with self.db_lock:
+            row = self.db.execute("SELECT value FROM shelf WHERE key = ?",
+                    (name,)).fetchone()
+            if not row:
+                raise KeyError(name)
+
+            contents = json.loads(row[0])
+            if type(contents) == dict and "entries" in contents:
+                contents["entries"] = [ json.loads(r[0]) for r in\
+                        self.db.execute("SELECT item FROM items WHERE url = ?\
+                            ORDER BY position", (name,)) ]
+
+        return contents
+
+    def __contains__(self, name):
+        if name == "control":
+            return name in self.cache
+
+        with self.db_lock:
+            row = self.db.execute("SELECT 1 FROM shelf WHERE key = ?",
+                    (name,)).fetchone()
+        return row != None
+
+    def __delitem__(self, name):
+        with self.db_lock:
+            self.db.execute("DELETE FROM shelf WHERE key = ?", (name,))
+            self.db.execute("DELETE FROM items WHERE url = ?", (name,))
+        self.update_mod()
+
+    def _select_items(self, name, ids):
+        ids = list(ids)
+        r = {}
+
+        for i in range(0, len(ids), SQLITE_CHUNK):
+            chunk = ids[i:i + SQLITE_CHUNK]
+            query = "SELECT id, position, item FROM items WHERE url = ? AND id IN (%s)" %\
+                    ", ".join([ "?" ] * len(chunk))
+
+            for id, position, item in self.db.execute(query, [ name ] + chunk):
+                r[id] = (position, json.loads(item))
+        return r
+
+    def get_items(self, name, ids):
+        with self.db_lock:
+            found = self._select_items(name, ids)
+
+        r = {}
+        for id in found:
+            r[id] = found[id][1]
+        return r
+
+    def update_items(self, name, changes):
+        updated = []
+        rows = []
+
+        with self.db_lock:
+            found = self._select_items(name, changes.keys())
+
+            for id in found:
+                position, item = found[id]
+                item.update(changes[id])
+                updated.append(item)
+                rows.append(self._item_row(name, position, item))
+
+            self.db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+        return updated
+
+    # Remove and return the entries stored under name that match condition,
+    # except those with ids in keep.
+
+    def _delete_items(self, name, condition, args, keep):
+        with self.db_lock:
+            items = [ json.loads(r[1]) for r in self.db.execute(\
+                    "SELECT id, item FROM items WHERE url = ? AND " + condition,
+                    (name,) + args) if r[0] not in keep ]
+
+            self.db.executemany("DELETE FROM items WHERE url = ? AND id = ?",
+                    [ (name, item["id"]) for item in items ])
+
+        if items:
+            self.mark_dirty(name)
+        return items
+
+    # Discard entries stored under name that were last updated before cutoff,
+    # if keep_unread is set, only discard those that are read. Entries with
+    # ids in keep are never discarded. Returns the discarded entries.
+    #
+    # If archive_cutoff is given, entries last updated at or before it are
+    # removed whatever their state and added to archived instead, so the
+    # caller can archive them.
+
+    def expire_items(self, name, cutoff, keep_unread, keep, archive_cutoff=None,
+            archived=None):
+        if archive_cutoff != None:
+            for item in self._delete_items(name, "canto_update <= ?",
+                    (archive_cutoff,), keep):
+                log.debug("Archiving: %s", item["id"])
+                archived.append(item)
+
+        condition = "canto_update < ?"
+        if keep_unread:
+            condition += " AND canto_state LIKE '%\"read\"%'"
+
+        expired = self._delete_items(name, condition, (cutoff,), keep)
+        for item in expired:
+            log.debug("Discarding: %s", item["id"])
+        return expired
+
+    # Committing is the expensive part, so that's left to the writer.
+
+    @wlock_feeds
+    def prepare_sync(self):
+        if self.cache == {}:
+            return []
+
+        names = self.dirty
+        self.mark_clean()
+        return [ (self.db_name, self._commit, (self.cache["control"].copy(),),
+            names) ]
+
+    def _commit(self, control):
+        with self.db_lock:
+            if not self.db:
+                return
+
+            self.db.execute("INSERT OR REPLACE INTO shelf VALUES (?, ?)",
+                    ("control", json.dumps(control)))
+            self.db.commit()
+
+        log.debug("Synced.")
+
+    def _everything(self):
+        with self.db_lock:
+            names = [ r[0] for r in self.db.execute("SELECT key FROM shelf") ]
+
+        r = {}
+        for name in names:
+            r[name] = self[name]
+        return r
+
+    @wlock_feeds
+    def export(self, path):
+        self.write_snapshot(self._everything(), path)
+
+    def close(self):
+        log.debug("Closing.")
+        if self.db:
+            self.flush()
+            self.db.close()
+            self.db = None
+        self.cache = {}
+        self.failed = []
+        call_hook("daemon_db_close", [self.filename])
+
+    @wlock_feeds
+    def replace(self, path):
+        self.close()
+        os.unlink(self.db_name)
+
+        # With the database gone, open() will migrate path.
+
+        shutil.move(path, self.filename)
+        self.open()
+
+storage_types = { "shelf" : CantoShelf,
+                  "lazy" : CantoLazyShelf,
+                  "mapped" : CantoMappedShelf,
+                  "journal" : CantoJournalShelf,
+                  "sharded" : CantoShardedShelf,
+                  "sqlite" : CantoSQLiteShelf }
+
+# Where each storage type keeps its feeds, appended to the shelf filename.
+
+storage_suffixes = { "shelf" : "",
+                     "lazy" : "",
+                     "mapped" : "",
+                     "journal" : "",
+                     "sharded" : ".d",
+                     "sqlite" : ".db" }
+
+# Only the single file shelf is converted when the storage type changes, and
+# the others rename it out of the way, so starting a different type over the
+# top of their feeds would silently start empty. Raise instead.
+
+def check_storage(filename, storage_type):
+    if os.path.exists(filename + storage_suffixes[storage_type]):
+        return
+    if os.path.exists(filename):
+        return
+
+    for other in sorted(storage_types.keys()):
+        path = filename + storage_suffixes[other]
+        if os.path.exists(path):
+            raise Exception("%s was written with --storage %s, which can't be"\
+                    " converted to %s. Start with --storage %s, or move %s"\
+                    " aside to start empty." %\
+                    (path, other, storage_type, other, path))
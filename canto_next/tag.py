@@ -15,9 +15,46 @@ log = logging.getLogger("TAG")
 
 class CantoTags():
     def __init__(self):
+
+        # The raw membership of each tag, as { id : None } so it keeps its
+        # order, and the transformed content that is actually served.
+
+        self.members = {}
         self.tags = {}
         self.changed_tags = []
 
+        # { id : set of tags } for the raw membership, so items_to_tags
+        # doesn't have to search every tag.
+
+        self.member_tags = {}
+
+        # Ids of read items, kept up to date by the feeds, and the number of
+        # (total, read) items in each tag's transformed content.
+
+        self.read_ids = set()
+        self.counts = {}
+
+        # Bumped whenever tags are cleared, so feeds know to forget what
+        # they've tagged.
+
+        self.generation = 0
+
+        # { tag : version } for the raw membership and the served content of
+        # each tag, taken from version, which only ever goes up.
+
+        self.version = 0
+        self.tag_versions = {}
+        self.served_versions = {}
+
+        # { tag : (key, [ output of each transform ]) } so transforms are only
+        # run again when the tag, or anything they depend on, has changed,
+        # and { tag : set of ids } for the items that have been added to it,
+        # or changed, since. With those, transforms that can may just update
+        # their last output.
+
+        self.transformed = {}
+        self.deltas = {}
+
         # Per-tag transforms
         self.tag_transforms = {}
 
@@ -31,15 +68,43 @@ class CantoTags():
     def items_to_tags(self, ids):
         tags = []
         for id in ids:
-            for tag in self.tags:
-                if id in self.tags[tag] and tag not in tags:
+            if id not in self.member_tags:
+                continue
+            for tag in self.member_tags[id]:
+                if tag not in tags:
                     tags.append(tag)
         return tags
 
+    # Return a list of the ways members and member_tags disagree, for tests.
+
+    def check_consistency(self):
+        errors = []
+
+        for tag, members in self.members.items():
+            for id in members:
+                if tag not in self.member_tags.get(id, set()):
+                    errors.append("%s in %s, not in its reverse map" % (id, tag))
+
+        for id, tags in self.member_tags.items():
+            if not tags:
+                errors.append("%s has an empty reverse map" % id)
+            for tag in tags:
+                if id not in self.members.get(tag, {}):
+                    errors.append("%s maps to %s, not in the tag" % (id, tag))
+
+        return errors
+
     def tag_changed(self, tag):
         if tag not in self.changed_tags:
             self.changed_tags.append(tag)
 
+    # The attributes of an item in tag have changed.
+
+    def item_changed(self, id, tag):
+        if tag in self.deltas:
+            self.deltas[tag].add(id)
+        self.tag_changed(tag)
+
     def get_tag(self, tag):
         if tag in list(self.tags.keys()):
             return self.tags[tag]
@@ -48,6 +113,17 @@ class CantoTags():
     def get_tags(self):
         return list(self.tags.keys())
 
+    def get_counts(self, tag):
+        if tag not in self.counts:
+            self.count_tag(tag)
+        total, read = self.counts[tag]
+        return { "total" : total, "read" : read, "unread" : total - read }
+
+    def count_tag(self, tag):
+        tagobj = self.get_tag(tag)
+        self.counts[tag] = (len(tagobj),
+                len([ id for id in tagobj if id in self.read_ids ]))
+
     def tag_transform(self, tag, transform):
         self.tag_transforms[tag] = transform
 
@@ -55,7 +131,16 @@ class CantoTags():
         self.extra_tags[tag] = extra_tags
 
     def clear_tags(self):
+        self.members = {}
+        self.member_tags = {}
         self.tags = {}
+        self.tag_versions = {}
+        self.served_versions = {}
+        self.transformed = {}
+        self.deltas = {}
+        self.read_ids = set()
+        self.counts = {}
+        self.generation += 1
 
     def reset(self):
         self.tag_transforms = {}
@@ -72,59 +157,188 @@ class CantoTags():
     # Following must be called with tag_lock held with write
     #
 
-    def add_tag(self, id, name):
-        if name in self.extra_tags:
-            extras = self.extra_tags[name]
-        else:
-            extras = []
+    # Return name, and the tags it's part of.
 
-        alladded = [ name ] + extras
+    def expand_tag(self, name):
+        if name in self.extra_tags:
+            return [ name ] + self.extra_tags[name]
+        return [ name ]
+
+    def _create_tag(self, name):
+        self.members[name] = {}
+        self.tags[name] = []
+        call_hook("daemon_new_tag", [[ name ]])
+
+    def _bump_version(self, versions, name):
+        self.version += 1
+        versions[name] = self.version
+
+    def _add_member(self, id, name, new=True):
+        self.members[name][id] = None
+        self._bump_version(self.tag_versions, name)
+        if new and name in self.deltas:
+            self.deltas[name].add(id)
+        if id not in self.member_tags:
+            self.member_tags[id] = set()
+        self.member_tags[id].add(name)
+
+    def _remove_member(self, id, name):
+        del self.members[name][id]
+        self._bump_version(self.tag_versions, name)
+        self.member_tags[id].discard(name)
+        if not self.member_tags[id]:
+            del self.member_tags[id]
 
-        for name in alladded:
+    def add_tag(self, id, name):
+        for name in self.expand_tag(name):
             # Create tag if no tag exists
-            if name not in self.tags:
-                self.tags[name] = []
-                call_hook("daemon_new_tag", [[ name ]])
+            if name not in self.members:
+                self._create_tag(name)
 
             # Add to tag.
-            if id not in self.tags[name]:
-                self.tags[name].append(id)
+            if id not in self.members[name]:
+                self._add_member(id, name)
                 self.tag_changed(name)
 
     def remove_tag(self, id, name):
-        if name in self.tags and id in self.tags[name]:
-            self.tags[name].remove(id)
+        if name in self.members and id in self.members[name]:
+            self._remove_member(id, name)
             self.tag_changed(name)
 
     def remove_id(self, id):
-        for tag in self.tags:
-            if id in self.tags[tag]:
-                self.tags[tag].remove(id)
+        if id in self.member_tags:
+            for tag in list(self.member_tags[id]):
+                self._remove_member(id, tag)
                 self.tag_changed(tag)
 
+    def set_read(self, id, read):
+        if read:
+            self.read_ids.add(id)
+        else:
+            self.read_ids.discard(id)
+
+    # Drop the ids in moved from the tag, and then append the ids in added, in
+    # order.
+
+    def update_tag(self, name, moved, added):
+        if name not in self.members:
+            self._create_tag(name)
+
+        members = self.members[name]
+        if len(moved) < len(members):
+            dropped = [ id for id in moved if id in members ]
+        else:
+            dropped = [ id for id in members if id in moved ]
+
+        for id in dropped:
+            self._remove_member(id, name)
+
+        # Ids that are only being moved aren't new to the transforms.
+
+        dropped = set(dropped)
+        for id in added:
+            if id not in members:
+                self._add_member(id, name, id not in dropped)
+
+        self.tag_changed(name)
+
     def apply_transforms(self, tag, tagobj):
         from .config import config
+        from .transform import transform_key
+
+        transforms = []
+
         # Global transform
         if config.global_transform:
-            tagobj = config.global_transform(tagobj)
+            transforms.append(config.global_transform)
 
         # Tag level transform
         if tag in self.tag_transforms and\
                 self.tag_transforms[tag]:
-            tagobj = self.tag_transforms[tag](tagobj)
-
+            transforms.append(self.tag_transforms[tag])
+
+        key = transform_key(transforms, tagobj)
+        if key == None:
+            self.forget_transformed(tag)
+            for transform in transforms:
+                tagobj = transform(tagobj)
+            return tagobj
+
+        key = (self.tag_versions.get(tag, 0), key)
+
+        outputs = None
+        if tag in self.transformed:
+            old_key, old_outputs = self.transformed[tag]
+            if old_key == key:
+                outputs = old_outputs
+            elif self._can_update(old_key, key):
+                changed = set([ id for id in self.deltas[tag]\
+                        if id in self.members[tag] ])
+                outputs = self._update_transforms(transforms, tagobj,
+                        old_outputs, changed)
+
+        if outputs == None:
+            outputs = []
+            for transform in transforms:
+                tagobj = transform(tagobj)
+                outputs.append(tagobj[:])
+
+        self.transformed[tag] = (key, outputs)
+        self.deltas[tag] = set()
+
+        if outputs:
+            return outputs[-1][:]
         return tagobj
 
+    def forget_transformed(self, tag):
+        if tag in self.transformed:
+            del self.transformed[tag]
+            del self.deltas[tag]
+
+    # The last outputs can be updated if only the tag's membership and the
+    # versions of individual attributes have changed, since those changes are
+    # all in deltas.
+
+    def _can_update(self, old_key, key):
+        old_transforms, old_version, old_tags = old_key[1]
+        transforms, version, tags = key[1]
+        return old_transforms == transforms and\
+                old_version[0] == version[0] and old_tags == tags
+
+    def _update_transforms(self, transforms, tagobj, old_outputs, changed):
+        outputs = []
+        for transform, old in zip(transforms, old_outputs):
+            items = tagobj
+            tagobj = transform.incremental(items[:], old, changed)
+
+            # Transforms that can't be updated are run in full, and anything
+            # that moved in or out of their output is new to the next one.
+
+            if tagobj == None:
+                tagobj = transform(items[:])
+                changed = changed | (set(tagobj) ^ set(old))
+
+            outputs.append(tagobj[:])
+        return outputs
+
     def do_tag_changes(self):
         for tag in self.changed_tags:
-            tagobj = self.get_tag(tag)
+            if tag not in self.members:
+                continue
+
+            tagobj = list(self.members[tag])
 
             try:
                 tagobj = self.apply_transforms(tag, tagobj)
             except Exception as e:
                 log.error("Exception applying transforms: %s" % e)
+                self.forget_transformed(tag)
+
+            if tagobj != self.tags[tag]:
+                self._bump_version(self.served_versions, tag)
 
             self.tags[tag] = tagobj
+            self.count_tag(tag)
             call_hook("daemon_tag_change", [ tag ])
         self.changed_tags = []
 
@@ -9,13 +9,24 @@
 from .feed import allfeeds
 from .tag import alltags
 
+from operator import itemgetter
+from itertools import compress
 import logging
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 log = logging.getLogger("TRANSFORM")
 
 transform_locals = { }
 
+# Past this fraction of changed items, an incremental sort isn't worth it.
+
+INCREMENTAL_FRACTION = 0.1
+
 # A Transform is generically any form of manipulation of the number of items
 # (filter) or order of those items (sort) based on some criteria.
 
@@ -33,29 +44,119 @@ class CantoTransform():
     # This is called with the feeds already read locked.
 
     def __call__(self, tag):
+        a = self.get_attributes(tag, self.needed_attributes(tag))
+
+        for item in tag[:]:
+            if item not in a.keys():
+                log.warn("Missing attributes for %s" % item)
+                tag.remove(item)
+
+        return self.transform(tag, a)
+
+    def get_attributes(self, items, needed):
         a = {}
-        f = allfeeds.items_to_feeds(tag)
-        needed = self.needed_attributes(tag)
+        f = allfeeds.items_to_feeds(items)
 
         for feed in f:
             attrs = {}
             for i in f[feed]:
                 attrs[i] = needed
             a.update(feed.get_attributes(f[feed], attrs))
+        return a
 
-        for item in tag[:]:
-            if item not in a.keys():
-                log.warn("Missing attributes for %s" % item)
-                tag.remove(item)
+    # Given items, the previous output, and the ids among items that are new
+    # or have changed since, return the new output without looking at the
+    # rest of the items' attributes. None means the transform has to be run in
+    # full.
 
-        return self.transform(tag, a)
+    def incremental(self, items, previous, changed):
+        return None
+
+    # An incremental() for transforms that keep or drop each item on its own
+    # attributes.
+
+    def incremental_filter(self, items, previous, changed):
+        fresh = [ item for item in items if item in changed ]
+        a = self.get_attributes(fresh, self.needed_attributes(items))
+        fresh = [ item for item in fresh if item in a ]
+
+        keep = set(previous) - changed
+        keep.update(self.transform(fresh, a))
+
+        return [ item for item in items if item in keep ]
 
     def needed_attributes(self, tag):
         return []
 
+    # Tags, besides the one being transformed, that the result depends on.
+
+    def needed_tags(self):
+        return []
+
     def transform(self, items, attrs):
         return items
 
+# An AttributeBatch lays the attributes transforms are given out as columns,
+# one list per attribute aligned with the items, so they can be filtered and
+# sorted all at once. NumPy is used for sorting, if it's installed.
+
+class AttributeBatch():
+    def __init__(self, items, attrs, needed):
+        self.items = items
+        self.columns = {}
+
+        rows = list(map(attrs.__getitem__, items))
+        for attr in needed:
+            self.columns[attr] = list(map(itemgetter(attr), rows))
+
+    # Return the items for which mask is true.
+
+    def select(self, mask):
+        return list(compress(self.items, mask))
+
+    # Return the items sorted by attr, and then by item.
+
+    def sort_by(self, attr):
+        column = self.columns[attr]
+
+        # Only a column of plain strings, or plain numbers, of a single type
+        # sorts the same way in numpy as it does in Python. numpy would turn a
+        # mix (like a score that's sometimes a string) into strings, where
+        # Python refuses to compare them.
+
+        keys = None
+        if numpy != None and self.items and\
+                len(set(map(type, column))) == 1 and type(column[0]) in [ int, float, str ]:
+            keys = numpy.array(column)
+
+        if keys is not None and keys.ndim == 1 and keys.dtype.kind in "USiuf":
+            order = numpy.argsort(numpy.array(self.items), kind="stable")
+            order = order[numpy.argsort(keys[order], kind="stable")]
+            return [ self.items[i] for i in order ]
+
+        # Otherwise, sorting by item and then (stably) by attr saves Python
+        # comparing tuples.
+
+        order = sorted(range(len(self.items)), key=self.items.__getitem__)
+        order.sort(key=column.__getitem__)
+        return list(map(self.items.__getitem__, order))
+
+# Return a key that changes whenever the result of applying transforms to tag
+# might, or None if that can't be known.
+
+def transform_key(transforms, tag):
+    attributes = []
+    tags = []
+
+    for t in transforms:
+        if not isinstance(t, CantoTransform):
+            return None
+        attributes += t.needed_attributes(tag)
+        tags += t.needed_tags()
+
+    return (tuple(transforms), allfeeds.attribute_version(attributes),
+            tuple([ alltags.tag_versions.get(t, 0) for t in tags ]))
+
 # A StateFilter will filter out items that match a particular state. Supports
 # using "-tag" to indicate to filter out those missing the tag.
 
@@ -67,6 +168,9 @@ class StateFilter(CantoTransform):
     def needed_attributes(self, tag):
         return ["canto-state"]
 
+    def incremental(self, items, previous, changed):
+        return self.incremental_filter(items, previous, changed)
+
     def transform(self, items, attrs):
         if self.state[0] == "-":
             state = self.state[1:]
@@ -75,8 +179,11 @@ class StateFilter(CantoTransform):
             state = self.state
             keep = False
 
-        return [ i for i in items if \
-                (state in attrs[i]["canto-state"]) == keep]
+        batch = AttributeBatch(items, attrs, [ "canto-state" ])
+        column = batch.columns["canto-state"]
+        if keep:
+            return batch.select([ state in s for s in column ])
+        return batch.select([ state not in s for s in column ])
 
 # Filter out items whose [attribute] content matches an arbitrary regex.
 
@@ -95,6 +202,9 @@ class ContentFilterRegex(CantoTransform):
             return []
         return [ self.attribute ]
 
+    def incremental(self, items, previous, changed):
+        return self.incremental_filter(items, previous, changed)
+
     def transform(self, items, attrs):
         if not self.match:
             return items
@@ -129,9 +239,53 @@ class SortTransform(CantoTransform):
         return [ self.attr ]
 
     def transform(self, items, attrs):
-        r = [ ( attrs[item][self.attr], item ) for item in items ]
-        r.sort()
-        return [ item[1] for item in r ]
+        return AttributeBatch(items, attrs, [ self.attr ]).sort_by(self.attr)
+
+    # Merge the changed items into the rest of the previous output, which is
+    # still in order. Only the items compared against need their attributes.
+
+    def incremental(self, items, previous, changed):
+        if len(changed) > len(items) * INCREMENTAL_FRACTION:
+            return None
+
+        present = set(items)
+        r = [ item for item in previous if item in present\
+                and item not in changed ]
+
+        fresh = [ item for item in changed if item in present ]
+        if len(r) + len(fresh) != len(items):
+            return None
+
+        keys = {}
+        def key(item):
+            if item not in keys:
+                a = self.get_attributes([ item ], [ self.attr ])
+                keys[item] = (a[item][self.attr], item)
+            return keys[item]
+
+        try:
+            a = self.get_attributes(fresh, [ self.attr ])
+            for item in fresh:
+                keys[item] = (a[item][self.attr], item)
+            fresh = sorted([ keys[item] for item in fresh ])
+
+            merged = []
+            start = 0
+            for k in fresh:
+                lo, hi = start, len(r)
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if key(r[mid]) < k:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                merged += r[start:lo]
+                merged.append(k[1])
+                start = lo
+        except KeyError:
+            return None
+
+        return merged + r[start:]
 
 # Meta-filter for AND
 class AllTransform(CantoTransform):
@@ -157,6 +311,14 @@ class AllTransform(CantoTransform):
                     needed.append(a)
         return needed
 
+    def needed_tags(self):
+        needed = []
+        for t in self.transforms:
+            for tag in t.needed_tags():
+                if tag not in needed:
+                    needed.append(tag)
+        return needed
+
     def transform(self, items, attrs):
         good_items = items[:]
         for t in self.transforms:
@@ -187,6 +349,14 @@ class AnyTransform(CantoTransform):
                     needed.append(a)
         return needed
 
+    def needed_tags(self):
+        needed = []
+        for t in self.transforms:
+            for tag in t.needed_tags():
+                if tag not in needed:
+                    needed.append(tag)
+        return needed
+
     def transform(self, items, attrs):
         good_items = []
         per_transform = []
@@ -210,6 +380,9 @@ class InTags(CantoTransform):
     def needed_attributes(self, tag):
         return []
 
+    def needed_tags(self):
+        return list(self.tags)
+
     def transform(self, items, attrs):
         good = []
 
@@ -51,14 +51,13 @@ from canto_next.remote import DaemonRemotePlugin
 from canto_next.config import parse_locks, parse_unlocks, config
 from canto_next.locks import config_lock, feed_lock
 from canto_next.feed import wlock_all, wunlock_all, rlock_all, runlock_all, allfeeds
+from canto_next.storage import read_shelf_file
 from canto_next.tag import alltags
 
 from tempfile import mkstemp
 import subprocess
 import logging
 import shutil
-import gzip
-import json
 import time
 import os
 
@@ -123,9 +122,7 @@ class CantoFileSync(DaemonBackendPlugin):
         log.debug("Checking if %s is older than our shelf.", path)
 
         try:
-            fp = gzip.open(path, "rt", 9, "UTF-8")
-            s = json.load(fp)
-            fp.close()
+            s = read_shelf_file(path)
         except:
             # If something messed up, assume that the sync failed and
             # pretend that we're newer anyway.
@@ -163,11 +160,10 @@ class CantoFileSync(DaemonBackendPlugin):
             # Lock feeds to make sure nothing's in flight
             wlock_all()
 
-            # Sync the shelf so it's all on disk
+            # Write a complete copy of the shelf, the feed_path on disk may
+            # not have the latest changes.
 
-            self.backend.shelf.sync()
-
-            shutil.copyfile(self.backend.feed_path, fname)
+            self.backend.shelf.export(fname)
 
             # Let everything else continue
             wunlock_all()
@@ -248,12 +244,8 @@ class CantoFileSync(DaemonBackendPlugin):
                 # Lock feeds to make sure nothing's in flight
                 wlock_all()
 
-                # Close the file so we can replace it.
-                self.backend.shelf.close()
-
-                shutil.move(fname, self.backend.feed_path)
-
-                self.backend.shelf.open()
+                # Swap in the new content.
+                self.backend.shelf.replace(fname)
 
                 # Clear out all of the currently tagged items. Usually on
                 # update, we're able to discard items that we have in old
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.tag import alltags
+import logging
+import time
+
+TEST_URL = "http://example.com/"
+DEF_KEEP_TIME = 86400
+
+NUM_ITEMS = 50000
+
+# Indexing used to drop duplicates with list.remove(), so a feed full of them
+# took the best part of a minute. It should be well under the limit now, even
+# on a slow machine.
+
+TIME_LIMIT = 10
+
+class TestFeedIndexLarge(Test):
+    def generate_update_contents(self, first, last, update_time):
+        entries = []
+        for i in range(first, last):
+            entries.append({ "id" : TEST_URL + "%d/" % i, "title" : "Title %d" % i })
+        return { "canto_update" : update_time, "entries" : entries }
+
+    def check(self):
+        logging.getLogger().setLevel(logging.INFO)
+
+        alltags.reset()
+        allfeeds.reset()
+
+        now = time.time()
+
+        test_shelf = {}
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10, DEF_KEEP_TIME, False)
+
+        self.banner("index %d entries" % NUM_ITEMS)
+
+        start = time.time()
+        test_feed.index(self.generate_update_contents(0, NUM_ITEMS, now - 300))
+        first = time.time() - start
+
+        print("First index: %.2fs" % first)
+
+        entries = test_shelf[TEST_URL]["entries"]
+        if len(entries) != NUM_ITEMS:
+            raise Exception("Wrong number of entries: %d" % len(entries))
+
+        for i in range(0, NUM_ITEMS, 2):
+            entries[i]["canto-state"] = [ "read" ]
+
+        self.banner("merge %d entries" % NUM_ITEMS)
+
+        # Half overlapping with the first update, in reverse order, and with
+        # every entry duplicated.
+
+        half = NUM_ITEMS // 2
+        update = self.generate_update_contents(half, NUM_ITEMS + half, now)
+        update["entries"].reverse()
+
+        dupes = self.generate_update_contents(half, NUM_ITEMS + half, now)
+        for e in dupes["entries"]:
+            e["title"] = "Dupe"
+        update["entries"] += dupes["entries"]
+
+        start = time.time()
+        test_feed.index(update)
+        second = time.time() - start
+
+        print("Second index: %.2fs" % second)
+
+        entries = test_shelf[TEST_URL]["entries"]
+        if len(entries) != NUM_ITEMS + half:
+            raise Exception("Wrong number of entries: %d" % len(entries))
+
+        # New content in the order it was given, then the unmatched old
+        # content in the order it was on disk.
+
+        expected = [ TEST_URL + "%d/" % i for i in reversed(range(half, NUM_ITEMS + half)) ]
+        expected += [ TEST_URL + "%d/" % i for i in range(half) ]
+
+        if [ e["id"] for e in entries ] != expected:
+            raise Exception("Entries out of order")
+
+        for e in entries:
+            i = int(e["id"][len(TEST_URL):-1])
+            if (i < NUM_ITEMS and i % 2 == 0) != ("canto-state" in e):
+                raise Exception("State not carried over: %s" % e)
+            if e["title"] == "Dupe":
+                raise Exception("Duplicate not discarded")
+
+        if len(alltags.tags["maintag:Test Feed"]) != NUM_ITEMS + half:
+            raise Exception("Wrong number of items in tag")
+
+        if first + second > TIME_LIMIT:
+            raise Exception("Indexing took too long: %.2fs" % (first + second))
+
+        return True
+
+TestFeedIndexLarge("feed index large")
@@ -4,12 +4,23 @@
 from base import *
 
 from canto_next.feed import CantoFeed, dict_id, allfeeds
+from canto_next.storage import CantoShelf
 from canto_next.tag import alltags
+from canto_next.hooks import on_hook, unhook_all
+import tempfile
+import shutil
 import time
 
 TEST_URL = "http://example.com/"
 DEF_KEEP_TIME = 86400
 
+class CountingShelf(CantoShelf):
+    loads = 0
+
+    def __getitem__(self, name):
+        self.loads += 1
+        return CantoShelf.__getitem__(self, name)
+
 class TestFeedIndex(Test):
 
     # Make sure all items in the feeds have all of their tags...
@@ -27,6 +38,10 @@ class TestFeedIndex(Test):
                         if tag not in alltags.items_to_tags([full_id]):
                             raise Exception("Item %s didn't make it into user tag %s" % (entry, tag))
 
+        errors = alltags.check_consistency()
+        if errors:
+            raise Exception("Tags inconsistent: %s" % errors)
+
         self.compare_tags_and_feeds(shelf)
 
     # ... and make sure that all tags have a real source in the feeds
@@ -98,6 +113,128 @@ class TestFeedIndex(Test):
 
         return test_feed, test_shelf, update
 
+    # Attribute lookups and changes go through the shelf's item methods, so
+    # these need a real one.
+
+    def check_with_shelf(self, tmpdir, content):
+        now = time.time()
+
+        self.banner("attribute projections")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        shelf = CantoShelf(tmpdir + "/projections")
+        feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, DEF_KEEP_TIME, False)
+        feed.index(self.generate_update_contents(10, content, now))
+
+        ids = [ feed._item_id(item) for item in shelf[TEST_URL]["entries"] ]
+        request = dict([ (id, [ "title", "canto-state" ]) for id in ids ])
+
+        first = feed.get_attributes(ids, request)
+        second = feed.get_attributes(ids, request)
+        if first != second or feed.hits != 10 or feed.misses != 10:
+            raise Exception("Bad projections: %s" % feed.projection_stats())
+
+        feed.set_attributes([ ids[0] ], { ids[0] : { "canto-state" : [ "read" ] } })
+        got = feed.get_attributes(ids, request)
+        if got[ids[0]]["canto-state"] != [ "read" ] or feed.misses != 11:
+            raise Exception("Stale projection: %s" % got[ids[0]])
+
+        contents = self.generate_update_contents(10, content, now)
+        contents["entries"][1]["title"] = "Changed"
+        feed.index(contents)
+
+        got = feed.get_attributes(ids, request)
+        if got[ids[1]]["title"] != "Changed":
+            raise Exception("Stale projection: %s" % got[ids[1]])
+
+        # Sorts like reddit_score_sort add to what they're given
+
+        got[ids[2]]["reddit-score"] = 1
+        got = feed.get_attributes(ids, request)
+        if "reddit-score" in got[ids[2]]:
+            raise Exception("Projection changed by caller: %s" % got[ids[2]])
+
+        stats = feed.projection_stats()
+        request = dict([ (id, [ "title", "description" ]) for id in ids ])
+        feed.get_attributes(ids, request)
+        if feed.projection_stats()["sets"] != stats["sets"]:
+            raise Exception("Cached content: %s" % feed.projection_stats())
+
+        shelf.close()
+
+        self.banner("batched attributes")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        shelf = CantoShelf(tmpdir + "/batched")
+        feeds = [ CantoFeed(shelf, "Feed %d" % i, TEST_URL + "%d/" % i, 10, DEF_KEEP_TIME, False)\
+                for i in range(2) ]
+
+        changes = {}
+        for feed in feeds:
+            feed.index(self.generate_update_contents(10, content, now))
+            for item in shelf[feed.URL]["entries"]:
+                changes[feed._item_id(item)] = { "canto-state" : [ "read" ],
+                        "canto-tags" : [ "user:batch" ] }
+
+        changed = []
+        on_hook("daemon_tag_change", changed.append, "test-batch")
+        try:
+            allfeeds.set_attributes(changes)
+        finally:
+            unhook_all("test-batch")
+
+        if sorted(changed) != [ "maintag:Feed 0", "maintag:Feed 1", "user:batch" ]:
+            raise Exception("Bad tag changes: %s" % changed)
+
+        if len(alltags.tags["user:batch"]) != 20:
+            raise Exception("Failed to tag items: %s" % alltags.tags["user:batch"])
+
+        for feed in feeds:
+            for item in shelf[feed.URL]["entries"]:
+                if item["canto-state"] != [ "read" ]:
+                    raise Exception("Failed to set attributes: %s" % item)
+
+        self.compare_feed_and_tags(shelf)
+        shelf.close()
+
+        self.banner("sweep kept unread items")
+
+        # Unread items we're keeping can't expire until they're read, so
+        # sweeping shouldn't keep going back to the shelf for them.
+
+        alltags.reset()
+        allfeeds.reset()
+
+        shelf = CountingShelf(tmpdir + "/sweep")
+        feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, 100, True)
+        feed.index(self.generate_update_contents(10, content, now - 1000))
+        feed.index(self.generate_update_contents(10, { "title" : "New %d" }, now))
+
+        loads = shelf.loads
+        feed.sweep()
+        feed.sweep()
+        if shelf.loads != loads:
+            raise Exception("Swept unread items: %d loads" % (shelf.loads - loads))
+
+        old = feed._item_id(shelf[TEST_URL]["entries"][10])
+        feed.set_attributes([ old ], { old : { "canto-state" : [ "read" ] } })
+        feed.sweep()
+
+        if len(shelf[TEST_URL]["entries"]) != 19:
+            raise Exception("Failed to sweep read item")
+
+        loads = shelf.loads
+        feed.sweep()
+        if shelf.loads != loads:
+            raise Exception("Swept unread items: %d loads" % (shelf.loads - loads))
+
+        self.compare_feed_and_tags(shelf)
+        shelf.close()
+
     def check(self):
         content = {
                 "title" : "Title %d",
@@ -198,6 +335,124 @@ class TestFeedIndex(Test):
         if nitems != 100:
             raise Exception("Wrong number of items in tag! %d - %s" % (nitems, tag))
 
+        self.banner("skip unchanged content")
+
+        test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now)
+
+        contents = test_shelf[TEST_URL]
+        test_feed.index(self.generate_update_contents(100, content, now))
+        if test_shelf[TEST_URL] is not contents:
+            raise Exception("Failed to skip unchanged content")
+
+        test_feed.index(self.generate_update_contents(99, content, now))
+        if test_shelf[TEST_URL] is contents:
+            raise Exception("Skipped changed content")
+
+        # Editing plugins have to see every update, changed or not.
+
+        edits = []
+        def edit_test(feed, newcontent, tags_to_add, tags_to_remove, remove_items):
+            edits.append(len(newcontent["entries"]))
+            return (tags_to_add, tags_to_remove, remove_items)
+
+        test_feed.plugin_attrs = { "edit_test" : edit_test }
+        test_feed.index(self.generate_update_contents(99, content, now))
+        test_feed.plugin_attrs = {}
+
+        if edits != [ 100 ]:
+            raise Exception("Skipped editing plugin: %s" % edits)
+
+        self.compare_feed_and_tags(test_shelf)
+
+        # Items in skipped content were still in the feed when it was skipped,
+        # so they're kept for keep_time after that, not after they were first
+        # indexed.
+
+        self.banner("skipped content ages from the skip")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        test_shelf = {}
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10, 100, False)
+
+        def read_items(ids, update_time):
+            return { "canto_update" : update_time, "entries" :\
+                    [ { "id" : id, "canto-state" : [ "read" ] } for id in ids ] }
+
+        test_feed.index(read_items([ "A", "B" ], now - 1000))
+        test_feed.index(read_items([ "A", "B" ], now))
+        test_feed.index(read_items([ "A" ], now))
+
+        ids = [ e["id"] for e in test_shelf[TEST_URL]["entries"] ]
+        if ids != [ "A", "B" ]:
+            raise Exception("Item seen by skipped fetch discarded: %s" % ids)
+
+        self.compare_feed_and_tags(test_shelf)
+
+        self.banner("differential retag")
+
+        test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now)
+
+        test_shelf[TEST_URL]["entries"][0]["canto-tags"] = [ "user:test" ]
+        test_feed.index(self.generate_update_contents(101, content, now))
+
+        if alltags.tags["user:test"] != [ test_feed._item_id(test_shelf[TEST_URL]["entries"][0]) ]:
+            raise Exception("Failed to add user tag: %s" % alltags.tags["user:test"])
+
+        changed = []
+        on_hook("daemon_tag_change", changed.append, "test-retag")
+        try:
+            test_feed.index(self.generate_update_contents(102, content, now))
+        finally:
+            unhook_all("test-retag")
+
+        if changed != [ "maintag:Test Feed" ]:
+            raise Exception("Unchanged tags touched: %s" % changed)
+
+        self.compare_feed_and_tags(test_shelf)
+
+        tag = alltags.tags["maintag:Test Feed"]
+        if tag != [ test_feed._item_id(e) for e in test_shelf[TEST_URL]["entries"] ]:
+            raise Exception("Tag not in feed order")
+
+        # Cleared tags have to be repopulated in full.
+
+        alltags.clear_tags()
+        test_feed.index({ "entries" : [] })
+
+        self.compare_feed_and_tags(test_shelf)
+
+        if len(alltags.tags["maintag:Test Feed"]) != 102:
+            raise Exception("Failed to repopulate tags")
+
+        self.banner("sweep")
+
+        test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now - 300)
+        test_feed.index(self.generate_update_contents(100, update_content, now))
+
+        # The current content stays, no matter how old it gets, the old items
+        # go without waiting for another fetch.
+
+        test_feed.keep_time = 0
+        test_feed.expire_due = 0
+        test_feed.sweep()
+
+        self.compare_feed_and_tags(test_shelf)
+
+        entries = test_shelf[TEST_URL]["entries"]
+        if [ e["id"] for e in entries ] != [ TEST_URL + "%d/updated" % i for i in range(100) ]:
+            raise Exception("Failed to sweep old items: %d" % len(entries))
+
+        if len(alltags.tags["maintag:Test Feed"]) != 100:
+            raise Exception("Failed to untag swept items")
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.check_with_shelf(tmpdir, content)
+        finally:
+            shutil.rmtree(tmpdir)
+
         return True
 
 TestFeedIndex("feed index")
@@ -0,0 +1,630 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.storage import CantoShelf, CantoLazyShelf, CantoMappedShelf, CantoJournalShelf, CantoShardedShelf, CantoSQLiteShelf
+from canto_next.storage import read_shelf_file, write_shelf_file, parse_shelf_format, MappedItem, check_storage
+
+from canto_next.feed import CantoFeed, allfeeds, dict_id
+from canto_next.item import CantoItem
+from canto_next.tag import alltags
+
+from threading import Event
+import tempfile
+import shutil
+import json
+import gzip
+import errno
+import time
+import os
+
+TEST_URL = "http://example.com/"
+
+class TestStorage(Test):
+    def generate_contents(self, num_items):
+        entries = []
+        for i in range(num_items):
+            entries.append({ "id" : "%d" % i, "title" : "Title %d" % i })
+        return { "canto_update" : 0, "entries" : entries }
+
+    # Make the shelf's next write fail like the disk filled up.
+
+    def fail_next_write(self, shelf):
+        def fail(data, filename):
+            del shelf.write_snapshot
+            raise OSError(errno.ENOSPC, "No space left on device")
+        shelf.write_snapshot = fail
+
+    def compare_shelf(self, shelf, expected):
+        for key in expected:
+            if key not in shelf:
+                raise Exception("Missing %s in shelf" % key)
+            if shelf[key] != expected[key]:
+                raise Exception("Mismatch on %s: %s" % (key, shelf[key]))
+
+    def check(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            return self._check(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _check(self, tmpdir):
+        filename = tmpdir + "/feeds"
+
+        self.banner("shelf formats")
+
+        data = { TEST_URL : self.generate_contents(10) }
+
+        for shelf_format in [ "none", "gzip", "gzip:1", "zlib:9", "lzma:0" ]:
+            write_shelf_file(data, filename, parse_shelf_format(shelf_format))
+            if read_shelf_file(filename) != data:
+                raise Exception("Failed to round trip %s" % shelf_format)
+
+            os.truncate(filename, os.path.getsize(filename) - 1)
+            try:
+                read_shelf_file(filename)
+            except:
+                pass
+            else:
+                raise Exception("Truncated %s shelf read" % shelf_format)
+
+        for shelf_format in [ "bzip", "gzip:10", "none:1", "lzma:x" ]:
+            try:
+                parse_shelf_format(shelf_format)
+            except ValueError:
+                continue
+            raise Exception("Accepted bad format %s" % shelf_format)
+
+        # Legacy, headerless gzip
+
+        fp = gzip.open(filename, "wt", 9, "UTF-8")
+        json.dump(data, fp, indent=4, sort_keys=True)
+        fp.close()
+
+        if read_shelf_file(filename) != data:
+            raise Exception("Failed to read legacy shelf")
+
+        os.unlink(filename)
+
+        self.banner("shelf round trip")
+
+        shelf = CantoShelf(filename)
+        shelf[TEST_URL] = self.generate_contents(10)
+        updated = shelf.update_items(TEST_URL, { "3" : { "canto-state" : [ "read" ] } })
+        if len(updated) != 1 or updated[0]["canto-state"] != [ "read" ]:
+            raise Exception("Failed to update item: %s" % updated)
+
+        expected = { TEST_URL : shelf[TEST_URL] }
+        shelf.close()
+
+        shelf = CantoShelf(filename)
+        self.compare_shelf(shelf, expected)
+
+        self.banner("item index")
+
+        got = shelf.get_items(TEST_URL, [ "3", "missing" ])
+        if list(got.keys()) != [ "3" ] or got["3"]["canto-state"] != [ "read" ]:
+            raise Exception("Bad get_items: %s" % got)
+
+        shelf.update_items(TEST_URL, { "3" : { "canto-state" : [] } })
+        if shelf.get_items(TEST_URL, [ "3" ])["3"]["canto-state"] != []:
+            raise Exception("Index not carried over update_items")
+
+        # Only the first update after a snapshot copies the entries, and the
+        # snapshot doesn't see later ones.
+
+        entries = shelf[TEST_URL]["entries"]
+        shelf.update_items(TEST_URL, { "4" : { "canto-state" : [] } })
+        if shelf[TEST_URL]["entries"] is not entries:
+            raise Exception("Entries copied without a snapshot")
+
+        snapshot = shelf.snapshot()
+        shelf.update_items(TEST_URL, { "4" : { "canto-state" : [ "read" ] } })
+        if snapshot[TEST_URL]["entries"][4]["canto-state"] != []:
+            raise Exception("Snapshot changed by update_items")
+        if shelf.get_items(TEST_URL, [ "4" ])["4"]["canto-state"] != [ "read" ]:
+            raise Exception("Lost update after snapshot")
+
+        # Replacing the entries has to invalidate the index.
+
+        contents = self.generate_contents(10)
+        contents["entries"].reverse()
+        shelf.cache[TEST_URL] = contents
+
+        got = shelf.get_items(TEST_URL, [ "3" ])["3"]
+        if got != { "id" : "3", "title" : "Title 3" }:
+            raise Exception("Stale item index: %s" % got)
+
+        shelf.cache[TEST_URL] = expected[TEST_URL]
+        shelf.mark_clean()
+
+        self.banner("dirty tracking")
+
+        mtime = os.stat(filename).st_mtime_ns
+        shelf.flush()
+        if os.stat(filename).st_mtime_ns != mtime:
+            raise Exception("Clean shelf rewritten")
+
+        shelf.update_items(TEST_URL, { "0" : { "sync-test" : 0 } })
+        if shelf.dirty != [ TEST_URL ]:
+            raise Exception("Bad dirty keys: %s" % shelf.dirty)
+
+        # Too soon after the change, so this should be debounced.
+
+        shelf.sync()
+        shelf.writer.wait()
+        if os.stat(filename).st_mtime_ns != mtime or not shelf.dirty:
+            raise Exception("Sync not debounced")
+
+        stats = shelf.stats()
+        if stats["skipped"] != 1 or stats["deferred"] != 1 or stats["performed"] != 0:
+            raise Exception("Bad sync stats: %s" % stats)
+
+        self.banner("background sync")
+
+        # Hold up the writer so the syncs queue behind it.
+
+        blocker = Event()
+        shelf.writer.submit(None, blocker.wait, ())
+
+        for i in range(3):
+            shelf.update_items(TEST_URL, { "0" : { "sync-test" : i } })
+            shelf.sync(True)
+
+        expected = { TEST_URL : shelf[TEST_URL] }
+
+        # Changes after the last sync shouldn't make it into the snapshot.
+
+        shelf.update_items(TEST_URL, { "0" : { "sync-test" : 3 } })
+
+        blocker.set()
+        shelf.writer.wait()
+
+        if shelf.writer.coalesced != 2:
+            raise Exception("Expected 2 coalesced syncs, got %d" % shelf.writer.coalesced)
+
+        if read_shelf_file(filename)[TEST_URL] != expected[TEST_URL]:
+            raise Exception("Background sync wrote the wrong snapshot")
+
+        self.banner("failed sync")
+
+        self.fail_next_write(shelf)
+        shelf.flush()
+
+        if shelf.dirty or shelf.failed != [ TEST_URL ]:
+            raise Exception("Failed write not noted: %s %s" % (shelf.dirty, shelf.failed))
+
+        # Closing should write what the failed sync didn't.
+
+        expected = { TEST_URL : shelf[TEST_URL] }
+        shelf.close()
+
+        if read_shelf_file(filename)[TEST_URL] != expected[TEST_URL]:
+            raise Exception("Failed sync never retried")
+
+        self.banner("journal replay")
+
+        shelf = CantoJournalShelf(filename)
+        self.compare_shelf(shelf, expected)
+
+        shelf["http://example.org/"] = self.generate_contents(5)
+        shelf.sync()
+        shelf.update_items(TEST_URL, { "5" : { "canto-state" : [ "read" ] } })
+        del shelf["http://example.org/"]
+        shelf.flush()
+
+        if not os.path.getsize(filename + ".journal"):
+            raise Exception("Nothing journaled")
+
+        expected = { TEST_URL : shelf[TEST_URL] }
+
+        # Simulate a crash, skipping close()
+
+        shelf.journal.close()
+
+        shelf = CantoJournalShelf(filename)
+        self.compare_shelf(shelf, expected)
+        if "http://example.org/" in shelf:
+            raise Exception("Deleted key came back")
+
+        self.banner("journal compaction")
+
+        shelf.update_items(TEST_URL, { "7" : { "canto-state" : [ "read" ] } })
+        shelf.sync()
+        shelf.compact()
+
+        if os.path.getsize(filename + ".journal"):
+            raise Exception("Journal not empty after compact")
+
+        expected = { TEST_URL : shelf[TEST_URL] }
+        shelf.close()
+
+        shelf = CantoShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        self.banner("sharded migration")
+
+        shelf = CantoShardedShelf(filename)
+        self.compare_shelf(shelf, expected)
+
+        if os.path.exists(filename):
+            raise Exception("Monolithic shelf left in place")
+
+        shards = os.listdir(filename + ".d")
+        if len(shards) != 2:
+            raise Exception("Expected control and one feed shard: %s" % shards)
+
+        self.banner("sharded dirty sync")
+
+        shelf["http://example.org/"] = self.generate_contents(5)
+        shelf.flush()
+
+        feed_shard = shelf.shard_name(TEST_URL)
+        mtime = os.stat(feed_shard).st_mtime_ns
+
+        shelf.update_items("http://example.org/", { "1" : { "canto-state" : [ "read" ] } })
+        shelf.flush()
+
+        if os.stat(feed_shard).st_mtime_ns != mtime:
+            raise Exception("Clean shard rewritten")
+
+        self.fail_next_write(shelf)
+        shelf.update_items("http://example.org/", { "2" : { "canto-state" : [ "read" ] } })
+        shelf.flush()
+
+        shelf.sync()
+        if shelf.dirty != [ "http://example.org/" ]:
+            raise Exception("Failed shard not marked dirty: %s" % shelf.dirty)
+
+        expected["http://example.org/"] = shelf["http://example.org/"]
+        shelf.close()
+
+        shelf = CantoShardedShelf(filename)
+        self.compare_shelf(shelf, expected)
+
+        self.banner("sharded export / replace")
+
+        exported = tmpdir + "/exported"
+        shelf.export(exported)
+        del shelf["http://example.org/"]
+        shelf.replace(exported)
+
+        self.compare_shelf(shelf, expected)
+
+        shelf.export(filename)
+        shelf.close()
+
+        self.banner("lazy loading")
+
+        shelf = CantoLazyShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        shelf = CantoLazyShelf(filename)
+        if sorted(shelf.blocks.keys()) != sorted(expected.keys()):
+            raise Exception("Feeds loaded on open: %s" % list(shelf.cache.keys()))
+
+        # Only touch one feed, the other should be copied without loading it.
+
+        shelf.update_items(TEST_URL, { "2" : { "sync-test" : 2 } })
+        expected[TEST_URL] = shelf[TEST_URL]
+        shelf.flush()
+
+        if "http://example.org/" in shelf.cache:
+            raise Exception("Untouched feed loaded by sync")
+
+        shelf.close()
+
+        shelf = CantoLazyShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        self.banner("mapped items")
+
+        shelf = CantoMappedShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        shelf = CantoMappedShelf(filename)
+        self.compare_shelf(shelf, expected)
+
+        item = shelf.get_items(TEST_URL, [ "3" ])["3"]
+        if not isinstance(item, MappedItem) or item["title"] != "Title 3":
+            raise Exception("Bad mapped item: %s" % item)
+
+        shelf.update_items(TEST_URL, { "3" : { "sync-test" : 3 } })
+        if "sync-test" in item:
+            raise Exception("Mapped item modified in place")
+
+        updated = shelf.get_items(TEST_URL, [ "3" ])["3"]
+        if updated["sync-test"] != 3 or updated["title"] != "Title 3":
+            raise Exception("Bad updated item: %s" % updated)
+
+        shelf.flush()
+
+        if TEST_URL in shelf.cache:
+            raise Exception("Synced feed not remapped")
+
+        on_disk = read_shelf_file(filename)
+        for key in expected:
+            expected[key] = on_disk[key]
+        if type(expected[TEST_URL]["entries"][3]) != dict:
+            raise Exception("read_shelf_file returned mapped items")
+
+        shelf.close()
+
+        shelf = CantoMappedShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        self.banner("sqlite migration")
+
+        shelf = CantoSQLiteShelf(filename)
+        self.compare_shelf(shelf, expected)
+
+        if os.path.exists(filename):
+            raise Exception("Monolithic shelf left in place")
+
+        self.banner("sqlite items")
+
+        got = shelf.get_items(TEST_URL, [ "1", "3", "missing" ])
+        if sorted(got.keys()) != [ "1", "3" ] or got["3"]["canto-state"] != [ "read" ]:
+            raise Exception("Bad get_items: %s" % got)
+
+        shelf.update_items(TEST_URL, { "4" : { "canto-state" : [ "read" ] } })
+        expected[TEST_URL]["entries"][4]["canto-state"] = [ "read" ]
+        self.compare_shelf(shelf, expected)
+
+        for i, entry in enumerate(expected[TEST_URL]["entries"]):
+            entry["canto_update"] = i
+        shelf[TEST_URL] = expected[TEST_URL]
+
+        # 0 - 5 are old enough, of those 3, 4 and 5 are read and 4 is protected.
+
+        expired = shelf.expire_items(TEST_URL, 6, True, [ "4" ])
+        if sorted([ item["id"] for item in expired ]) != [ "3", "5" ]:
+            raise Exception("Bad expire_items: %s" % expired)
+
+        expired = shelf.expire_items(TEST_URL, 6, False, [])
+        if sorted([ item["id"] for item in expired ]) != [ "0", "1", "2", "4" ]:
+            raise Exception("Bad expire_items: %s" % expired)
+
+        expected[TEST_URL]["entries"] = expected[TEST_URL]["entries"][6:]
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        shelf = CantoSQLiteShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        self.banner("truncated shelf recovery")
+
+        filename = tmpdir + "/crash"
+
+        shelf = CantoShelf(filename)
+        shelf[TEST_URL] = self.generate_contents(10)
+        shelf.flush()
+
+        expected = { TEST_URL : shelf[TEST_URL] }
+
+        shelf["http://example.org/"] = self.generate_contents(5)
+        shelf.close()
+
+        # Simulate a write that never made it to disk.
+
+        os.truncate(filename, os.path.getsize(filename) // 2)
+
+        shelf = CantoShelf(filename)
+        self.compare_shelf(shelf, expected)
+        if "http://example.org/" in shelf:
+            raise Exception("Recovered the wrong generation")
+        if not os.path.exists(filename + ".corrupt"):
+            raise Exception("Bad shelf not moved aside")
+        shelf.close()
+
+        shelf = CantoShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        self.banner("corrupt block recovery")
+
+        filename = tmpdir + "/lazy-crash"
+
+        shelf = CantoLazyShelf(filename)
+        shelf[TEST_URL] = self.generate_contents(10)
+        shelf["http://example.org/"] = self.generate_contents(5)
+        shelf.flush()
+
+        expected = { TEST_URL : shelf[TEST_URL] }
+
+        shelf["control"]["canto-modified"] = 0
+        shelf.mark_dirty("control")
+        shelf.close()
+
+        shelf = CantoLazyShelf(filename)
+        block = shelf.blocks[TEST_URL]
+        shelf.close()
+
+        fp = open(filename, "r+b")
+        fp.seek(block.offset + block.length // 2)
+        fp.write(b"X")
+        fp.close()
+
+        shelf = CantoLazyShelf(filename)
+        self.compare_shelf(shelf, expected)
+        shelf.close()
+
+        self.banner("feed archiving")
+
+        # SQLite expires items itself, so check it still archives them, even
+        # when they're past keep_time too.
+
+        for shelf_class in [ CantoShelf, CantoSQLiteShelf ]:
+            alltags.reset()
+            allfeeds.reset()
+
+            shelf = shelf_class(tmpdir + "/archive-" + shelf_class.__name__)
+            feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, 600, False,
+                    archive_time = 3600)
+
+            old = self.generate_contents(10)
+            old["canto_update"] = time.time() - 7200
+            feed.index(old)
+
+            new = self.generate_contents(15)
+            new["entries"] = new["entries"][5:]
+            new["canto_update"] = time.time()
+            feed.index(new)
+
+            ids = [ item["id"] for item in shelf[TEST_URL]["entries"] ]
+            if sorted(ids, key=int) != [ str(i) for i in range(5, 15) ]:
+                raise Exception("Old items not archived: %s" % ids)
+
+            archived = feed.get_archived()
+            if sorted([ dict_id(i)["ID"] for i in archived ], key=int) != [ str(i) for i in range(5) ]:
+                raise Exception("Bad archived items: %s" % archived)
+
+            if len(alltags.tags["maintag:Test Feed"]) != 10:
+                raise Exception("Archived items still tagged")
+
+            shelf.close()
+
+        self.banner("reindex on open")
+
+        # Indexing a feed from disk, like the daemon does on startup, shouldn't
+        # write anything back, or for the lazy shelves, read the feed.
+
+        for shelf_class in [ CantoShelf, CantoLazyShelf, CantoMappedShelf,
+                CantoJournalShelf, CantoShardedShelf, CantoSQLiteShelf ]:
+            alltags.reset()
+            allfeeds.reset()
+
+            name = tmpdir + "/reindex-" + shelf_class.__name__
+            shelf = shelf_class(name)
+            feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, 86400, False)
+            feed.index(self.generate_contents(10))
+            shelf.update_items(TEST_URL, { "0" : { "canto-state" : [ "read" ],
+                "canto-tags" : [ "user:reindex" ] } })
+            expected = { TEST_URL : shelf[TEST_URL] }
+            shelf.close()
+
+            alltags.reset()
+            allfeeds.reset()
+
+            shelf = shelf_class(name)
+            feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, 86400, False)
+            feed.index({ "entries" : [] })
+
+            if shelf.dirty:
+                raise Exception("Reindex dirtied shelf: %s" % shelf.dirty)
+
+            if shelf_class in [ CantoLazyShelf, CantoMappedShelf ] and\
+                    TEST_URL in shelf.cache:
+                raise Exception("Reindex read feed")
+
+            if len(alltags.tags["maintag:Test Feed"]) != 10 or\
+                    len(alltags.tags["user:reindex"]) != 1:
+                raise Exception("Reindex failed to tag items")
+
+            if feed.counts()["read"] != 1:
+                raise Exception("Bad counts after reindex: %s" % feed.counts())
+
+            written = shelf.writer.written
+            shelf.flush()
+            if shelf.writer.written != written:
+                raise Exception("Reindex written to disk")
+
+            self.compare_shelf(shelf, expected)
+            shelf.close()
+
+        self.banner("storage switch")
+
+        # Feeds converted out of the single file shelf can't be read by it, or
+        # the other converted type, so those refuse to start instead.
+
+        name = tmpdir + "/switch"
+        shelf = CantoShelf(name)
+        shelf[TEST_URL] = self.generate_contents(10)
+        shelf.close()
+
+        for storage_type in [ "shelf", "lazy", "sharded" ]:
+            check_storage(name, storage_type)
+
+        shelf = CantoShardedShelf(name)
+        shelf.close()
+
+        check_storage(name, "sharded")
+        for storage_type in [ "shelf", "lazy", "mapped", "journal", "sqlite" ]:
+            try:
+                check_storage(name, storage_type)
+            except Exception as e:
+                if "--storage sharded" not in str(e):
+                    raise
+            else:
+                raise Exception("Started %s over sharded feeds" % storage_type)
+
+        self.banner("compact items")
+
+        item = CantoItem({ "id" : "1", "title" : "Title", "summary" : "Summary",
+            "canto-state" : [ "read" ] })
+
+        copy = item.copy()
+        copy["summary"] = "Changed"
+        if item["summary"] != "Summary" or copy == item:
+            raise Exception("Copy not independent: %s" % item)
+
+        copy.update({ "canto_update" : 1 })
+        del copy["canto-state"]
+        if "canto-state" in copy or dict(copy.items()) != { "id" : "1",
+                "title" : "Title", "summary" : "Changed", "canto_update" : 1 }:
+            raise Exception("Bad item: %s" % copy)
+
+        alltags.reset()
+        allfeeds.reset()
+
+        for shelf_class in [ CantoShelf, CantoMappedShelf, CantoJournalShelf, CantoSQLiteShelf ]:
+            shelf = shelf_class(tmpdir + "/compact-" + shelf_class.__name__)
+            feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, 86400, False,
+                    stored_attributes = [ "title" ])
+
+            # Editing plugins still get everything, and what they change is
+            # stored.
+
+            def edit_test(feed, newcontent, tags_to_add, tags_to_remove, remove_items):
+                for entry in newcontent["entries"]:
+                    if entry.get("summary") != "Summary":
+                        raise Exception("Plugin saw trimmed item: %s" % entry)
+                    entry["title"] = "Edited " + entry["summary"]
+                return (tags_to_add, tags_to_remove, remove_items)
+
+            feed.plugin_attrs = { "edit_test" : edit_test }
+
+            contents = self.generate_contents(10)
+            for entry in contents["entries"]:
+                entry["summary"] = "Summary"
+            feed.index(contents)
+
+            expected = shelf[TEST_URL]
+            for entry in expected["entries"]:
+                if "summary" in entry or entry["title"] != "Edited Summary":
+                    raise Exception("Bad stored attributes: %s" % entry)
+
+            shelf.close()
+            shelf = shelf_class(tmpdir + "/compact-" + shelf_class.__name__)
+            self.compare_shelf(shelf, { TEST_URL : expected })
+            shelf.close()
+
+        # Clients get description from summary, so storing it keeps summary.
+
+        feed = CantoFeed({}, "Test Feed", TEST_URL, 10, 86400, False,
+                stored_attributes = [ "description" ])
+        item = feed._compact({ "id" : "1", "title" : "Title", "summary" : "Summary" })
+        if dict(item.items()) != { "id" : "1", "summary" : "Summary" }:
+            raise Exception("Bad description alias: %s" % item)
+
+        return True
+
+TestStorage("storage")
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.transform import CantoTransform, StateFilter, SortTransform
+from canto_next.config import config
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.storage import CantoShelf
+from canto_next.tag import alltags
+import tempfile
+import shutil
+
+TEST_URL = "http://example.com/"
+
+class CountingTransform(CantoTransform):
+    def __init__(self):
+        CantoTransform.__init__(self, "Counting")
+        self.calls = 0
+
+    def needed_attributes(self, tag):
+        return [ "canto-state" ]
+
+    def __call__(self, tag):
+        self.calls += 1
+        return tag[::-1]
+
+class CountingFilter(StateFilter):
+    calls = 0
+
+    def __call__(self, tag):
+        self.calls += 1
+        return StateFilter.__call__(self, tag)
+
+class CountingSort(SortTransform):
+    calls = 0
+
+    def __call__(self, tag):
+        self.calls += 1
+        return SortTransform.__call__(self, tag)
+
+class TestTags(Test):
+    def generate_contents(self, num_items):
+        entries = []
+        for i in range(num_items):
+            entries.append({ "id" : "%d" % i, "title" : "Title %d" % i })
+        return { "canto_update" : 0, "entries" : entries }
+
+    def check_transformed(self, feed, shelf, calls):
+        entries = shelf[TEST_URL]["entries"]
+        expected = [ (e["title"], feed._item_id(e)) for e in entries\
+                if "read" not in e.get("canto-state", []) ]
+        expected = [ id for title, id in sorted(expected) ]
+
+        got = alltags.get_tag("maintag:" + feed.name)
+        if got != expected:
+            raise Exception("Bad transformed tag: %s != %s" % (got, expected))
+
+        if (config.global_transform.calls, self.sort.calls) != calls:
+            raise Exception("Wrong number of full transforms: %s" %\
+                    ((config.global_transform.calls, self.sort.calls),))
+
+    def transform_calls(self, transform, expected):
+        alltags.tag_changed("maintag:Test")
+        alltags.do_tag_changes()
+
+        if transform.calls != expected:
+            raise Exception("Expected %d transforms, got %d" % (expected, transform.calls))
+
+    def check(self):
+        alltags.reset()
+
+        self.banner("membership")
+
+        for i in range(10):
+            alltags.add_tag("id%d" % i, "maintag:Test")
+            if i % 2 == 0:
+                alltags.add_tag("id%d" % i, "user:even")
+
+        # Adding an id twice doesn't move it.
+
+        alltags.add_tag("id0", "maintag:Test")
+
+        alltags.do_tag_changes()
+
+        if alltags.get_tag("maintag:Test") != [ "id%d" % i for i in range(10) ]:
+            raise Exception("Tag out of order: %s" % alltags.get_tag("maintag:Test"))
+
+        alltags.remove_tag("id4", "user:even")
+        alltags.remove_id("id2")
+        alltags.do_tag_changes()
+
+        if alltags.get_tag("user:even") != [ "id0", "id6", "id8" ]:
+            raise Exception("Failed to remove ids: %s" % alltags.get_tag("user:even"))
+
+        if "id2" in alltags.get_tag("maintag:Test"):
+            raise Exception("Failed to remove id from all tags")
+
+        if alltags.member_tags["id6"] != set([ "maintag:Test", "user:even" ]):
+            raise Exception("Bad reverse map: %s" % alltags.member_tags["id6"])
+
+        self.banner("update")
+
+        alltags.update_tag("maintag:Test", { "id1" : [], "id3" : [] }, [ "id3", "id10" ])
+        alltags.do_tag_changes()
+
+        expected = [ "id0", "id4", "id5", "id6", "id7", "id8", "id9", "id3", "id10" ]
+        if alltags.get_tag("maintag:Test") != expected:
+            raise Exception("Bad update: %s" % alltags.get_tag("maintag:Test"))
+
+        if "id1" in alltags.member_tags:
+            raise Exception("Failed to drop id from reverse map")
+
+        self.banner("items to tags")
+
+        tags = alltags.items_to_tags([ "id0", "id1", "id3" ])
+        if sorted(tags) != [ "maintag:Test", "user:even" ]:
+            raise Exception("Bad items_to_tags: %s" % tags)
+
+        errors = alltags.check_consistency()
+        if errors:
+            raise Exception("Tags inconsistent: %s" % errors)
+
+        self.banner("transform cache")
+
+        config.global_transform = None
+
+        t = CountingTransform()
+        alltags.tag_transform("maintag:Test", t)
+
+        self.transform_calls(t, 1)
+        self.transform_calls(t, 1)
+
+        if alltags.get_tag("maintag:Test") != expected[::-1]:
+            raise Exception("Bad cached result: %s" % alltags.get_tag("maintag:Test"))
+
+        allfeeds.attributes_changed([ "title" ])
+        self.transform_calls(t, 1)
+
+        allfeeds.attributes_changed([ "canto-state" ])
+        self.transform_calls(t, 2)
+
+        alltags.add_tag("id11", "maintag:Test")
+        self.transform_calls(t, 3)
+
+        allfeeds.attributes_changed()
+        self.transform_calls(t, 4)
+
+        # Make sure the checker actually catches something.
+
+        alltags.members["user:even"]["id1"] = None
+        if not alltags.check_consistency():
+            raise Exception("Failed to notice inconsistency")
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.check_feeds(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        return True
+
+    # Counts and transforms of tags full of real feed items.
+
+    def check_feeds(self, tmpdir):
+        self.banner("read counts")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        shelf = CantoShelf(tmpdir + "/counts")
+        feeds = [ CantoFeed(shelf, "Feed %d" % i, TEST_URL + "%d/" % i, 10, 86400, False)\
+                for i in range(2) ]
+
+        changes = {}
+        for feed in feeds:
+            feed.index(self.generate_contents(10))
+            for item in shelf[feed.URL]["entries"]:
+                changes[feed._item_id(item)] = { "canto-state" : [ "read" ],
+                        "canto-tags" : [ "user:batch" ] }
+        allfeeds.set_attributes(changes)
+
+        counts = alltags.get_counts("user:batch")
+        if counts != { "total" : 20, "read" : 20, "unread" : 0 }:
+            raise Exception("Bad tag counts: %s" % counts)
+
+        feeds[0].index(self.generate_contents(12))
+        unread = list(changes.keys())[10]
+        feeds[1].set_attributes([ unread ], { unread : { "canto-state" : [] } })
+
+        for feed, expected in [ (feeds[0], (12, 10)), (feeds[1], (10, 9)) ]:
+            counts = feed.counts()
+            if (counts["total"], counts["read"]) != expected:
+                raise Exception("Bad feed counts: %s" % counts)
+
+            counts = alltags.get_counts("maintag:" + feed.name)
+            if (counts["total"], counts["read"]) != expected:
+                raise Exception("Bad tag counts: %s" % counts)
+
+        counts = alltags.get_counts("user:batch")
+        if counts != { "total" : 20, "read" : 19, "unread" : 1 }:
+            raise Exception("Bad tag counts: %s" % counts)
+
+        shelf.close()
+
+        self.banner("incremental transforms")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        config.global_transform = CountingFilter("read")
+        self.sort = CountingSort("Sort", "title")
+        alltags.tag_transform("maintag:Test Feed", self.sort)
+
+        shelf = CantoShelf(tmpdir + "/incremental")
+        feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, 86400, False)
+        feed.index(self.generate_contents(100))
+
+        self.check_transformed(feed, shelf, (1, 1))
+
+        # Reading items, and new items, only need the items involved
+        # evaluated.
+
+        ids = [ feed._item_id(e) for e in shelf[TEST_URL]["entries"] ]
+        feed.set_attributes(ids[:3], dict([ (id, { "canto-state" : [ "read" ] }) for id in ids[:3] ]))
+        self.check_transformed(feed, shelf, (1, 1))
+
+        feed.index(self.generate_contents(101))
+        self.check_transformed(feed, shelf, (1, 1))
+
+        feed.set_attributes([ ids[1] ], { ids[1] : { "canto-state" : [] } })
+        self.check_transformed(feed, shelf, (1, 1))
+
+        # Changed content means everything has to be evaluated again.
+
+        contents = self.generate_contents(101)
+        contents["entries"][50]["title"] = "Changed"
+        feed.index(contents)
+        self.check_transformed(feed, shelf, (2, 2))
+
+        del config.global_transform
+        shelf.close()
+
+TestTags("tags")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.transform import StateFilter, SortTransform, AttributeBatch
+import canto_next.transform as transform
+import random
+import time
+
+NUM_ITEMS = 50000
+
+# The way transforms used to go through attributes, an item at a time.
+
+def row_filter(state, items, attrs):
+    return [ i for i in items if (state in attrs[i]["canto-state"]) == False ]
+
+def row_sort(attr, items, attrs):
+    r = [ ( attrs[item][attr], item ) for item in items ]
+    r.sort()
+    return [ item[1] for item in r ]
+
+class TestTransformBatch(Test):
+    def timed(self, label, fn, *args):
+        start = time.time()
+        r = fn(*args)
+        print("%s: %.3fs" % (label, time.time() - start))
+        return r
+
+    def check(self):
+        random.seed(0)
+
+        items = []
+        attrs = {}
+        for i in range(NUM_ITEMS):
+            id = '{"URL": "http://example.com/", "ID": "%d"}' % i
+            items.append(id)
+            attrs[id] = { "title" : "Title %d" % random.randint(0, NUM_ITEMS // 10),
+                    "canto-state" : random.choice([ [], [ "read" ], [ "read", "marked" ] ]) }
+
+        print("numpy: %s" % (transform.numpy != None))
+
+        self.banner("filter %d items" % NUM_ITEMS)
+
+        expected = self.timed("rows", row_filter, "read", items, attrs)
+        got = self.timed("columns", StateFilter("read").transform, items, attrs)
+        if got != expected:
+            raise Exception("Columnar filter differs")
+
+        self.banner("sort %d items" % NUM_ITEMS)
+
+        expected = self.timed("rows", row_sort, "title", items, attrs)
+        got = self.timed("columns", SortTransform("Sort", "title").transform, items, attrs)
+        if got != expected:
+            raise Exception("Columnar sort differs")
+
+        # Values numpy can't sort like Python does still sort.
+
+        batch = AttributeBatch([ "a", "b", "c" ],
+                { "a" : { "x" : [ 2 ] }, "b" : { "x" : [ 1 ] }, "c" : { "x" : [ 1 ] } }, [ "x" ])
+        if batch.sort_by("x") != [ "b", "c", "a" ]:
+            raise Exception("Bad sort: %s" % batch.sort_by("x"))
+
+        # Mixed types can't be compared, whether numpy is around or not.
+
+        batch = AttributeBatch([ "a", "b", "c" ],
+                { "a" : { "x" : 10 }, "b" : { "x" : "9" }, "c" : { "x" : 2 } }, [ "x" ])
+        try:
+            r = batch.sort_by("x")
+        except TypeError:
+            pass
+        else:
+            raise Exception("Mixed types sorted: %s" % r)
+
+        return True
+
+TestTransformBatch("transform batch")